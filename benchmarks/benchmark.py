@@ -0,0 +1,329 @@
+"""
+Benchmarks of the server app, driven through the Flask test client (no network).
+
+Each layer-store size is benchmarked in a fresh process: a synthetic `layers.json` with N layers built from local podpac
+nodes (Array and Arange) is generated in a temporary directory, `src/server.py` is imported with settings pointing to
+it, and each scenario (GetCapabilities, GetMap, GetCoverage, publishing API, ...) is run `--repeat` times. The response
+caches (GetMap, GetCoverage, and capabilities documents) are disabled unless `--cache` is given, so the renders are
+measured. The caches that were enabled are listed in the results (`caches`).
+
+Usage:
+    python benchmarks/benchmark.py run --layers 10 100 1000 --repeat 50 --output before.json
+    python benchmarks/benchmark.py run --layers 100 --output after.json
+    python benchmarks/benchmark.py compare before.json after.json
+
+The `remove` scenario removes the layers published by the `publish` scenario, so it should run after it (as it does by
+default). `run --replay traffic.jsonl` additionally replays recorded requests, one JSON object per line with a `path` (including
+the query string) and optionally a `method` and a `body`.
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import resource
+import tempfile
+import platform
+import subprocess
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+KEY = "benchmark-key"
+SCENARIOS = [
+    "wms_getcapabilities",
+    "wcs_getcapabilities",
+    "wms_getmap",
+    "wcs_getcoverage",
+    "publish",
+    "query",
+    "remove",
+    "ui_spec",
+]
+
+
+def make_node(i):
+    """Synthetic layer `i`: a small lat/lon Array, or an Arange"""
+    import podpac
+
+    if i % 2:
+        return podpac.algorithm.Arange(style=podpac.style.Style(colormap="viridis"))
+    coordinates = podpac.Coordinates(
+        [podpac.clinspace(50, 24, 52, "lat"), podpac.clinspace(-125, -66, 118, "lon")], crs="EPSG:4326"
+    )
+    data = np.random.RandomState(i).rand(52, 118)
+    return podpac.data.Array(
+        source=data, coordinates=coordinates, style=podpac.style.Style(colormap="RdBu", clim=[0, 1])
+    )
+
+
+def make_store(path, n):
+    """Write a layer store with `n` synthetic layers, as published through the API (including the metadata)"""
+    import podpac
+    from server_layers import make_layer_metadata
+
+    layers = {}
+    for i in range(n):
+        node = make_node(i)
+        layers["layer_{}".format(i)] = {
+            "author_key": KEY,
+            "definition": node.definition,
+            "expiration": None,
+            "metadata": make_layer_metadata(node),
+        }
+    with open(path, "w") as file:
+        json.dump(layers, file, cls=podpac.core.utils.JSONEncoder)
+
+
+def _bbox(rng):
+    lat = rng.uniform(25, 45)
+    lon = rng.uniform(-120, -75)
+    size = rng.uniform(1, 5)
+    return lat, lon, lat + size, lon + size
+
+
+def make_request(scenario, i, n, rng):
+    """Returns `(method, path, body)` for iteration `i` of `scenario`"""
+    import podpac
+
+    layer = "layer_{}".format(2 * rng.randrange(max(n // 2, 1)))  # Array layers
+    if scenario == "wms_getcapabilities":
+        return "GET", "/api/?SERVICE=WMS&REQUEST=GetCapabilities&VERSION=1.3.0", None
+    if scenario == "wcs_getcapabilities":
+        return "GET", "/api/?SERVICE=WCS&REQUEST=GetCapabilities&VERSION=1.0.0", None
+    if scenario == "wms_getmap":
+        lat0, lon0, lat1, lon1 = _bbox(rng)
+        return "GET", (
+            "/api/?SERVICE=WMS&VERSION=1.3.0&REQUEST=GetMap&LAYERS={}&STYLES=&CRS=EPSG:4326&BBOX={},{},{},{}"
+            "&WIDTH=256&HEIGHT=256&FORMAT=image/png&TRANSPARENT=TRUE"
+        ).format(layer, lat0, lon0, lat1, lon1), None
+    if scenario == "wcs_getcoverage":
+        lat0, lon0, lat1, lon1 = _bbox(rng)
+        return "GET", (
+            "/api/?SERVICE=WCS&VERSION=1.0.0&REQUEST=GetCoverage&COVERAGE={}&CRS=EPSG:4326&BBOX={},{},{},{}"
+            "&WIDTH=256&HEIGHT=256&FORMAT=GeoTIFF"
+        ).format(layer, lon0, lat0, lon1, lat1), None
+    if scenario == "publish":
+        # Array definitions include their coordinates objects, which the layer store cannot serialize
+        data = podpac.algorithm.SinCoords(style=podpac.style.Style(colormap="RdBu", clim=[-0.5, 0.5])).json
+        return "POST", "/api/publish/?SERVICE=PUBLISH&KEY={}&NAME=benchmark_{}".format(KEY, i), data
+    if scenario == "query":
+        return "GET", "/api/publish/?SERVICE=QUERY&KEY={}&NAME=layer_0".format(KEY), None
+    if scenario == "remove":
+        return "GET", "/api/publish/?SERVICE=REMOVE&KEY={}&NAME=benchmark_{}".format(KEY, i), None
+    if scenario == "ui_spec":
+        return "GET", "/api/publish/UI_spec", None
+    raise ValueError("Unknown scenario '{}'".format(scenario))
+
+
+def summarize(latencies, errors, elapsed):
+    ms = np.array(latencies) * 1000
+    return {
+        "count": len(latencies),
+        "errors": errors,
+        "throughput": len(latencies) / elapsed if elapsed else None,
+        "mean_ms": float(ms.mean()),
+        "p50_ms": float(np.percentile(ms, 50)),
+        "p90_ms": float(np.percentile(ms, 90)),
+        "p99_ms": float(np.percentile(ms, 99)),
+        "max_ms": float(ms.max()),
+    }
+
+
+def is_error(response):
+    if response.status_code >= 400:
+        return True
+    if response.mimetype == "application/json":
+        body = response.get_json(silent=True)
+        return isinstance(body, dict) and body.get("status") == "Error"
+    return False
+
+
+def run_requests(client, requests):
+    latencies = []
+    errors = 0
+    start = time.perf_counter()
+    for method, path, body in requests:
+        t = time.perf_counter()
+        response = client.open(path, method=method, data=body)
+        response.get_data()
+        latencies.append(time.perf_counter() - t)
+        errors += is_error(response)
+    return summarize(latencies, errors, time.perf_counter() - start)
+
+
+def load_replay(path):
+    requests = []
+    with open(path) as file:
+        for line in file:
+            try:
+                item = json.loads(line)
+                requests.append((item.get("method", "GET"), item["path"], item.get("body")))
+            except (ValueError, KeyError, TypeError, AttributeError):
+                continue  # not a recorded request
+    return requests
+
+
+def run_size(n, repeat, scenarios, cache, replay=None, seed=0):
+    """Benchmark a store with `n` layers in this process (see `run`)"""
+    tmp = tempfile.mkdtemp(prefix="rpp-benchmark-")
+    os.chdir(tmp)
+    sys.path.insert(0, os.path.join(ROOT, "src"))
+    store = os.path.join(tmp, "layers.json")
+    settings = {
+        "PUBLISHED_PIPELINES": {"path": store, "secret_key": [KEY]},
+        "GETMAP_CACHE": {
+            "ram_bytes": 2.56e8 if cache else 0,
+            "disk_path": os.path.join(tmp, "getmap") if cache else None,
+        },
+        "GETCOVERAGE_CACHE": {"disk_path": os.path.join(tmp, "getcoverage")} if cache else {},
+        "DOCUMENT_CACHE": {"max_entries": 1000 if cache else 0},
+    }
+    os.environ["SETTINGS"] = json.dumps(settings)
+
+    make_store(store, n)
+    start = time.perf_counter()
+    with open(os.devnull, "w") as devnull:  # server.py prints the environment and the layers on startup
+        stdout, sys.stdout = sys.stdout, devnull
+        try:
+            import server
+        finally:
+            sys.stdout = stdout
+    caches = {
+        "getmap_ram": server.GETMAP_CACHE.ram is not None,
+        "getmap_disk": server.GETMAP_CACHE.disk is not None,
+        "getcoverage_disk": server.COVERAGE_CACHE is not None,
+        "documents": server.DOCUMENT_CACHE.max_entries > 0,
+    }
+    result = {
+        "layers": n,
+        "startup_s": time.perf_counter() - start,
+        "caches": sorted(name for name, enabled in caches.items() if enabled),
+        "scenarios": {},
+    }
+
+    client = server.app.test_client()
+    rng = random.Random(seed)
+    for scenario in scenarios:
+        requests = [make_request(scenario, i, n, rng) for i in range(repeat)]
+        if scenario not in ["publish", "remove"]:
+            client.open(requests[0][1], method=requests[0][0])  # warm up (e.g. lazily built nodes)
+        result["scenarios"][scenario] = run_requests(client, requests)
+    if replay:
+        result["scenarios"]["replay"] = run_requests(client, load_replay(replay))
+
+    result["peak_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0  # KB on Linux
+    return result
+
+
+def run(args):
+    results = {
+        "meta": {
+            "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "commit": _git_commit(),
+            "repeat": args.repeat,
+            "cache": args.cache,
+        },
+        "results": {},
+    }
+    for n in args.layers:
+        # Fresh process for each store size: server.py loads its layers on import
+        command = [
+            sys.executable, os.path.abspath(__file__), "_size", str(n), "--repeat", str(args.repeat),
+            "--scenarios", *args.scenarios,
+        ]
+        command += ["--cache"] if args.cache else []
+        command += ["--replay", os.path.abspath(args.replay)] if args.replay else []
+        print("Benchmarking {} layers...".format(n), file=sys.stderr)
+        output = subprocess.run(command, check=True, stdout=subprocess.PIPE).stdout
+        results["results"][str(n)] = json.loads(output.decode().strip().splitlines()[-1])
+        _print_size(results["results"][str(n)])
+
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(text)
+    else:
+        print(text)
+
+
+def compare(args):
+    """Print the relative change of the latency percentiles and throughput of `new` compared to `base`"""
+    with open(args.base) as file:
+        base = json.load(file)["results"]
+    with open(args.new) as file:
+        new = json.load(file)["results"]
+    regressions = 0
+    print("{:>6} {:<22} {:>10} {:>10} {:>10} {:>10}".format("layers", "scenario", "p50 ms", "p90 ms", "p99 ms", "req/s"))
+    for n in sorted(set(base) & set(new), key=int):
+        for scenario in sorted(set(base[n]["scenarios"]) & set(new[n]["scenarios"])):
+            b, c = base[n]["scenarios"][scenario], new[n]["scenarios"][scenario]
+            changes = [_change(b[k], c[k]) for k in ["p50_ms", "p90_ms", "p99_ms", "throughput"]]
+            regression = changes[0] > args.threshold or changes[1] > args.threshold
+            regressions += regression
+            print("{:>6} {:<22} {:>+9.0%} {:>+9.0%} {:>+9.0%} {:>+9.0%}{}".format(
+                n, scenario, *changes, "  REGRESSION" if regression else ""))
+        print("{:>6} {:<22} {:>+9.0%} (peak RSS)".format(n, "", _change(base[n]["peak_rss_mb"], new[n]["peak_rss_mb"])))
+    return 1 if regressions else 0
+
+
+def _change(base, new):
+    return (new - base) / base if base else 0.0
+
+
+def _print_size(result):
+    print("{} layers: startup {:.2f} s, peak RSS {:.0f} MB".format(
+        result["layers"], result["startup_s"], result["peak_rss_mb"]), file=sys.stderr)
+    for scenario, s in result["scenarios"].items():
+        print("  {:<22} p50 {:8.1f} ms  p99 {:8.1f} ms  {:8.1f} req/s  {} errors".format(
+            scenario, s["p50_ms"], s["p99_ms"], s["throughput"], s["errors"]), file=sys.stderr)
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=ROOT, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True
+        ).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks of the server app")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    p = commands.add_parser("run", help="Run the benchmarks")
+    p.add_argument("--layers", nargs="+", type=int, default=[10, 100, 1000], help="Layer-store sizes")
+    p.add_argument("--repeat", type=int, default=50, help="Requests per scenario")
+    p.add_argument("--scenarios", nargs="+", default=SCENARIOS, choices=SCENARIOS)
+    p.add_argument("--cache", action="store_true", help="Enable the response caches")
+    p.add_argument("--replay", help="JSON-lines file of recorded requests to replay")
+    p.add_argument("--output", help="Output JSON file (default: stdout)")
+
+    p = commands.add_parser("compare", help="Compare two runs")
+    p.add_argument("base")
+    p.add_argument("new")
+    p.add_argument("--threshold", type=float, default=0.1, help="Relative p50/p90 increase flagged as a regression")
+
+    # Internal: benchmark one store size in this process, prints the result as JSON
+    p = commands.add_parser("_size")
+    p.add_argument("layers", type=int)
+    p.add_argument("--repeat", type=int, default=50)
+    p.add_argument("--scenarios", nargs="+", default=SCENARIOS)
+    p.add_argument("--cache", action="store_true")
+    p.add_argument("--replay")
+
+    args = parser.parse_args(argv)
+    if args.command == "run":
+        return run(args)
+    if args.command == "compare":
+        return compare(args)
+    result = run_size(args.layers, args.repeat, args.scenarios, args.cache, args.replay)
+    print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
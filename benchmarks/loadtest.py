@@ -0,0 +1,385 @@
+"""
+Load tests of the server under a local multi-worker WSGI server, to expose contention between workers (layer-store
+writes, OGC rebuilds, shared caches and locks) that single-request benchmarks do not show.
+
+For each number of workers, a synthetic layer store (see `benchmark.py`) is generated in a temporary directory, the app
+is started with that many worker processes, and `--clients` concurrent clients send a mix of XYZ tile, WCS GetCoverage
+and publishing requests for `--duration` seconds. The report gives the throughput (and its scaling with the number of
+workers) and the latency percentiles of each kind of request. After each run, every layer whose publication succeeded
+is looked up through the publishing API: layers lost by concurrent publishes are reported, and make the load test fail.
+
+The app runs under gunicorn (sync workers, like the production setup) if it is installed, or under a minimal pre-fork
+server (`--server prefork`): worker processes that import the app and accept connections on a shared socket, one
+request at a time.
+
+Usage:
+    python benchmarks/loadtest.py run --workers 1 2 4 8 --clients 32 --duration 30 --mix tile=8 coverage=1 publish=1
+    python benchmarks/loadtest.py run --workers 4 --layers 1000 --output load.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import socket
+import signal
+import shutil
+import argparse
+import tempfile
+import threading
+import subprocess
+import http.client
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from benchmark import ROOT, KEY, make_store, make_request, summarize, _git_commit
+
+sys.path.insert(0, os.path.join(ROOT, "src"))
+
+KINDS = ["tile", "getmap", "coverage", "capabilities", "publish", "query"]
+DEFAULT_MIX = {"tile": 8, "coverage": 1, "publish": 1}
+
+
+def make_load_request(kind, i, n, rng):
+    """Returns `(method, path, body)` of a request of `kind`, `i` making the names of published layers unique"""
+    if kind == "tile":
+        from tiles import lonlat_to_tile
+
+        layer = "layer_{}".format(2 * rng.randrange(max(n // 2, 1)))
+        z = rng.randint(3, 8)
+        x, y = lonlat_to_tile(rng.uniform(-120, -70), rng.uniform(26, 48), z)
+        return "GET", "/api/tiles/{}/{}/{}/{}.png".format(layer, z, x, y), None
+    if kind == "getmap":
+        return make_request("wms_getmap", i, n, rng)
+    if kind == "coverage":
+        return make_request("wcs_getcoverage", i, n, rng)
+    if kind == "capabilities":
+        return make_request("wms_getcapabilities", i, n, rng)
+    if kind == "publish":
+        return make_request("publish", i, n, rng)
+    if kind == "query":
+        return make_request("query", i, n, rng)
+    raise ValueError("Unknown request kind '{}'".format(kind))
+
+
+def send(port, method, path, body=None, timeout=300):
+    """Returns `(status, body)`"""
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=timeout)
+    try:
+        headers = {"Content-Type": "application/json"} if body else {}
+        connection.request(method, path, body=body, headers=headers)
+        response = connection.getresponse()
+        return response.status, response.read()
+    finally:
+        connection.close()
+
+
+def is_error(status, body):
+    if status >= 400:
+        return True
+    if body[:1] == b"{":
+        try:
+            return json.loads(body.decode()).get("status") == "Error"
+        except (ValueError, UnicodeDecodeError, AttributeError):
+            return False
+    return False
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(server, workers, port, env):
+    if server == "gunicorn":
+        command = [
+            sys.executable, "-m", "gunicorn", "-b", "127.0.0.1:{}".format(port), "-w", str(workers), "-t", "0",
+            "--chdir", os.path.join(ROOT, "src"), "server:app",
+        ]
+    else:
+        command = [sys.executable, os.path.abspath(__file__), "_serve", str(port), "--workers", str(workers)]
+    return subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL)
+
+
+def wait_ready(process, port, timeout):
+    """Wait until the server answers GetCapabilities requests"""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("The server exited with status {}".format(process.returncode))
+        try:
+            status, _ = send(port, "GET", "/api/?SERVICE=WMS&REQUEST=GetCapabilities&VERSION=1.3.0", timeout=timeout)
+            if status == 200:
+                return
+        except OSError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError("The server did not start within {} s".format(timeout))
+
+
+def stop_server(process):
+    process.terminate()
+    try:
+        process.wait(10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+class Client(threading.Thread):
+    """Sends requests of random kinds (following `mix`) back to back until `stop` is set"""
+
+    def __init__(self, index, port, n, mix, stop, seed):
+        super().__init__(daemon=True)
+        self.index = index
+        self.port = port
+        self.n = n
+        self.kinds = list(mix)
+        self.weights = [mix[k] for k in self.kinds]
+        self.stop = stop
+        self.rng = random.Random(seed * 1000 + index)
+        self.latencies = {kind: [] for kind in self.kinds}
+        self.errors = {kind: 0 for kind in self.kinds}
+        self.first_errors = {}  # kind --> description of the first error
+        self.published = []
+        self.measure = False
+
+    def run(self):
+        i = 0
+        while not self.stop.is_set():
+            kind = self.rng.choices(self.kinds, self.weights)[0]
+            # Published layer names are unique across clients and runs
+            method, path, body = make_load_request(kind, "{}_{}".format(self.index, i), self.n, self.rng)
+            i += 1
+            start = time.perf_counter()
+            try:
+                status, data = send(self.port, method, path, body)
+                error = is_error(status, data)
+                if error:
+                    self.first_errors.setdefault(kind, "{} {}: {}".format(status, path, data[:200].decode(errors="replace")))
+            except OSError as e:
+                error = True
+                self.first_errors.setdefault(kind, "{}: {}".format(path, e))
+            if kind == "publish" and not error:
+                self.published.append(path.rsplit("NAME=", 1)[1])
+            if self.measure:
+                self.latencies[kind].append(time.perf_counter() - start)
+                self.errors[kind] += error
+
+
+def check_published(port, names):
+    """Names of the successfully published layers that are missing from the server"""
+    status, body = send(port, "GET", "/api/publish/?SERVICE=QUERY&KEY={}".format(KEY))
+    pipelines = json.loads(body.decode()).get("pipelines", {})
+    return sorted(set(names) - set(pipelines))
+
+
+def run_workers(workers, args, mix):
+    tmp = tempfile.mkdtemp(prefix="rpp-loadtest-")
+    try:
+        store = os.path.join(tmp, "layers.json")
+        make_store(store, args.layers)
+        settings = {
+            "PUBLISHED_PIPELINES": {"path": store, "secret_key": [KEY]},
+            "GETMAP_CACHE": {
+                "ram_bytes": 2.56e8 if args.cache else 0,
+                "disk_path": os.path.join(tmp, "getmap") if args.cache else None,
+            },
+            "GETCOVERAGE_CACHE": {"disk_path": os.path.join(tmp, "getcoverage")} if args.cache else {},
+            "COALESCE_RENDERS": {"lock_path": os.path.join(tmp, "locks")},
+            "ADMISSION": {"lock_path": os.path.join(tmp, "admission")},
+            "METRICS": {"path": os.path.join(tmp, "metrics")},
+        }
+        env = dict(os.environ, SETTINGS=json.dumps(settings))
+        port = _free_port()
+        process = start_server(args.server, workers, port, env)
+        try:
+            wait_ready(process, port, args.startup_timeout)
+            stop = threading.Event()
+            clients = [Client(i, port, args.layers, mix, stop, args.seed) for i in range(args.clients)]
+            for client in clients:
+                client.start()
+            time.sleep(args.warmup)
+            for client in clients:
+                client.measure = True
+            start = time.perf_counter()
+            time.sleep(args.duration)
+            for client in clients:
+                client.measure = False
+            elapsed = time.perf_counter() - start
+            stop.set()
+            for client in clients:
+                client.join()
+
+            published = [name for client in clients for name in client.published]
+            lost = check_published(port, published)
+        finally:
+            stop_server(process)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    result = {"workers": workers, "duration_s": elapsed, "kinds": {}}
+    for kind in mix:
+        latencies = [t for client in clients for t in client.latencies[kind]]
+        errors = sum(client.errors[kind] for client in clients)
+        if latencies:
+            result["kinds"][kind] = summarize(latencies, errors, elapsed)
+            first = [client.first_errors[kind] for client in clients if kind in client.first_errors]
+            if first:
+                result["kinds"][kind]["first_error"] = first[0]
+    latencies = [t for client in clients for kind in mix for t in client.latencies[kind]]
+    result["total"] = summarize(latencies, sum(s["errors"] for s in result["kinds"].values()), elapsed)
+    result["published"] = len(published)
+    result["lost"] = lost
+    return result
+
+
+def run(args):
+    mix = parse_mix(args.mix)
+    results = {
+        "meta": {
+            "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "commit": _git_commit(),
+            "server": args.server,
+            "layers": args.layers,
+            "clients": args.clients,
+            "duration": args.duration,
+            "mix": mix,
+            "cache": args.cache,
+        },
+        "results": [],
+    }
+    for workers in args.workers:
+        print("Load testing {} workers...".format(workers), file=sys.stderr)
+        result = run_workers(workers, args, mix)
+        base = results["results"][0]["total"]["throughput"] if results["results"] else result["total"]["throughput"]
+        result["speedup"] = result["total"]["throughput"] / base if base else None
+        results["results"].append(result)
+        _print_result(result)
+
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(text)
+    else:
+        print(text)
+    return 1 if any(result["lost"] for result in results["results"]) else 0
+
+
+def parse_mix(items):
+    mix = {}
+    for item in items:
+        kind, _, weight = item.partition("=")
+        if kind not in KINDS:
+            raise ValueError("Unknown request kind '{}', expected one of {}".format(kind, KINDS))
+        mix[kind] = float(weight or 1)
+    return mix
+
+
+def _print_result(result):
+    total = result["total"]
+    print("{} workers: {:.1f} req/s (x{:.2f}), p50 {:.1f} ms, p99 {:.1f} ms, {} errors, {}/{} published layers lost".format(
+        result["workers"], total["throughput"], result["speedup"], total["p50_ms"], total["p99_ms"], total["errors"],
+        len(result["lost"]), result["published"]), file=sys.stderr)
+    for kind, s in result["kinds"].items():
+        print("  {:<14} {:6d} requests  p50 {:8.1f} ms  p99 {:8.1f} ms  max {:8.1f} ms  {} errors".format(
+            kind, s["count"], s["p50_ms"], s["p99_ms"], s["max_ms"], s["errors"]), file=sys.stderr)
+        if "first_error" in s:
+            print("    first error: {}".format(s["first_error"]), file=sys.stderr)
+
+
+def serve(port, workers):
+    """Minimal pre-fork server: `workers` processes serving one request at a time on a shared socket"""
+    from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_message(self, *args):
+            pass
+
+    class WorkerServer(WSGIServer):
+        def server_bind(self):
+            self.server_name, self.server_port = self.server_address
+            self.setup_environ()
+
+    listener = socket.socket()
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(("127.0.0.1", port))
+    listener.listen(128)
+
+    children = []
+    for _ in range(workers):
+        pid = os.fork()
+        if pid:
+            children.append(pid)
+            continue
+        # Worker: import the app (like gunicorn without --preload) and serve
+        os.chdir(os.path.join(ROOT, "src"))
+        sys.path.insert(0, os.getcwd())
+        import server
+
+        httpd = WorkerServer(("127.0.0.1", port), QuietHandler, bind_and_activate=False)
+        httpd.socket.close()
+        httpd.socket = listener
+        httpd.server_bind()
+        httpd.set_app(server.app)
+        try:
+            httpd.serve_forever()
+        finally:
+            os._exit(0)
+
+    def terminate(*args):
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    signal.signal(signal.SIGTERM, lambda *args: (terminate(), sys.exit(0)))
+    try:
+        for _ in children:
+            os.wait()
+    finally:
+        terminate()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load tests of the server under a multi-worker WSGI server")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    p = commands.add_parser("run", help="Run the load test")
+    p.add_argument("--workers", nargs="+", type=int, default=[1, 2, 4, 8], help="Numbers of worker processes")
+    p.add_argument("--clients", type=int, default=32, help="Concurrent clients")
+    p.add_argument("--duration", type=float, default=30, help="Measured seconds per number of workers")
+    p.add_argument("--warmup", type=float, default=5, help="Seconds of unmeasured traffic before measuring")
+    p.add_argument("--layers", type=int, default=100, help="Layer-store size")
+    p.add_argument(
+        "--mix", nargs="+", default=["{}={}".format(k, v) for k, v in DEFAULT_MIX.items()],
+        help="Request kinds and weights, kinds: {}".format(", ".join(KINDS)),
+    )
+    p.add_argument("--server", choices=["gunicorn", "prefork"], default=_default_server())
+    p.add_argument("--cache", action="store_true", help="Enable the response caches")
+    p.add_argument("--seed", type=int, default=0)
+    p.add_argument("--startup-timeout", type=float, default=300)
+    p.add_argument("--output", help="Output JSON file (default: stdout)")
+
+    # Internal: pre-fork server
+    p = commands.add_parser("_serve")
+    p.add_argument("port", type=int)
+    p.add_argument("--workers", type=int, default=1)
+
+    args = parser.parse_args(argv)
+    if args.command == "run":
+        return run(args)
+    serve(args.port, args.workers)
+
+
+def _default_server():
+    try:
+        import gunicorn
+    except ImportError:
+        return "prefork"
+    return "gunicorn"
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,174 @@
+"""
+Admission control for expensive renders, shared by all workers on a host.
+
+Renders hold a slot of their request type (e.g. "getcoverage") and a slot of their layer while they run. Requests that
+cannot get their slots wait in a bounded queue, and are rejected (see `Overloaded`) when the queue is full or when they
+waited too long, so that a burst of expensive requests cannot occupy every worker.
+
+Slots and queue places are lock files held with `flock`: they are shared by the threads and processes of a host, and
+released by the OS if a worker dies.
+"""
+import os
+import time
+import fcntl
+import hashlib
+import contextlib
+
+import traitlets as tl
+
+
+class Overloaded(Exception):
+    """The request was rejected, it should be retried after `retry_after` seconds"""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class _Slots(object):
+    """`size` lock files, of which a caller holds (at most) one"""
+
+    def __init__(self, path, name, size):
+        self.paths = [os.path.join(path, "{}.{}.lock".format(name, i)) for i in range(size)]
+
+    def try_acquire(self):
+        """Returns the open (locked) file of a free slot, or None"""
+        for path in self.paths:
+            file = open(path, "a")
+            try:
+                fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return file
+            except OSError:
+                file.close()
+        return None
+
+    @staticmethod
+    def release(file):
+        if file is not None:
+            fcntl.flock(file, fcntl.LOCK_UN)
+            file.close()
+
+    def count(self):
+        """Number of slots in use"""
+        used = 0
+        for path in self.paths:
+            with open(path, "a") as file:
+                try:
+                    fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    fcntl.flock(file, fcntl.LOCK_UN)
+                except OSError:
+                    used += 1
+        return used
+
+
+class AdmissionControl(tl.HasTraits):
+    """Limits the number of concurrent renders per request type and per layer, host-wide.
+
+    Attributes
+    ----------
+    lock_path : str
+        Directory of the lock files, shared by all workers on the host
+    slots : dict
+        Request type (lower-case, e.g. "getmap", "getcoverage") --> number of concurrent renders. Request types that
+        are not listed are not limited.
+    layer_slots : int
+        Number of concurrent renders per layer (0 for no limit)
+    queue : int
+        Number of requests (per request type) that can wait for a slot. Requests beyond that are rejected right away.
+    timeout : float
+        Maximum time (seconds) a request waits for its slots
+    retry_after : int
+        Seconds, sent to rejected clients in the Retry-After header
+    """
+
+    lock_path = tl.Unicode("data/cache/admission")
+    slots = tl.Dict()
+    layer_slots = tl.Int(0)
+    queue = tl.Int(8)
+    timeout = tl.Float(30.0)
+    retry_after = tl.Int(5)
+    poll_interval = tl.Float(0.05)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lock_path = os.path.abspath(self.lock_path)
+        os.makedirs(self.lock_path, exist_ok=True)
+        self.rejected = 0
+
+    def _type_slots(self, request_type):
+        if not self.slots.get(request_type):
+            return None
+        return _Slots(self.lock_path, request_type, int(self.slots[request_type]))
+
+    def _queue_slots(self, request_type):
+        return _Slots(self.lock_path, request_type + ".queue", self.queue)
+
+    def _layer_slots(self, layer):
+        if not self.layer_slots:
+            return None
+        # Layer names can contain any character, so the lock files are named after a hash
+        return _Slots(self.lock_path, "layer." + hashlib.sha1(layer.encode("utf8")).hexdigest()[:16], self.layer_slots)
+
+    @contextlib.contextmanager
+    def admit(self, request_type, layer):
+        """Holds a slot of `request_type` and of `layer` for the duration of the block.
+
+        Raises
+        ------
+        Overloaded
+            If the queue is full, or if the slots could not be acquired within `timeout` seconds
+        """
+        request_type = request_type.lower()
+        limiters = [s for s in [self._type_slots(request_type), self._layer_slots(layer)] if s is not None]
+        if not limiters:
+            yield
+            return
+
+        held = self._try_acquire(limiters)
+        try:
+            if held is None:
+                place = self._queue_slots(request_type).try_acquire()
+                if place is None:
+                    self.rejected += 1
+                    raise Overloaded("Too many {} requests".format(request_type), self.retry_after)
+                try:
+                    deadline = time.time() + self.timeout
+                    while held is None:
+                        if time.time() >= deadline:
+                            self.rejected += 1
+                            raise Overloaded("Timed out waiting for a {} slot".format(request_type), self.retry_after)
+                        time.sleep(self.poll_interval)
+                        held = self._try_acquire(limiters)
+                finally:
+                    _Slots.release(place)
+            yield
+        finally:
+            for file in held or []:
+                _Slots.release(file)
+
+    @staticmethod
+    def _try_acquire(limiters):
+        """Returns the slots of all `limiters`, or None (holding none of them) if one of them has no free slot.
+        Waiting requests never hold a slot: a request queued for a busy layer does not keep a type slot from requests
+        for other layers."""
+        held = []
+        for slots in limiters:
+            file = slots.try_acquire()
+            if file is None:
+                for file in held:
+                    _Slots.release(file)
+                return None
+            held.append(file)
+        return held
+
+    def status(self):
+        """Renders in progress and queued requests, per request type"""
+        status = {}
+        for request_type, size in self.slots.items():
+            if size:
+                status[request_type] = {
+                    "slots": int(size),
+                    "active": self._type_slots(request_type).count(),
+                    "queued": self._queue_slots(request_type).count(),
+                }
+        return status
@@ -0,0 +1,529 @@
+"""
+Caches for encoded OGC responses (e.g. rendered WMS GetMap tiles, capabilities documents).
+
+Responses are cached under a key computed from the normalized request (see `make_request_key`), which includes a hash
+of the layer definitions, so entries can never be served for an outdated definition. Entries are additionally grouped
+by layer so they can be dropped as soon as a layer is changed or removed.
+"""
+import os
+import math
+import errno
+import gzip
+import fcntl
+import json
+import time
+import shutil
+import hashlib
+import threading
+import contextlib
+from collections import OrderedDict
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+import traitlets as tl
+
+
+def _hash(*items):
+    return hashlib.sha1(json.dumps(items, sort_keys=True).encode("utf8")).hexdigest()
+
+
+def make_request_key(args, layers, definition_hashes, keys, bbox_tolerance=0.01):
+    """Normalized key for an OGC request
+
+    Parameters
+    ----------
+    args : dict
+        Request arguments, with lower-case keys
+    layers : list
+        Names of the requested layers
+    definition_hashes : list
+        Hashes of the definitions of the requested layers
+    keys : list
+        Request arguments that affect the response (lower-case). Everything else (e.g. the TOKEN) is ignored.
+    bbox_tolerance : float, optional
+        The BBOX is rounded to this fraction of a pixel, so that requests that only differ by floating-point noise
+        share the same entry. Default 0.01.
+
+    Returns
+    -------
+    str
+    """
+    normalized = OrderedDict()
+    for key in keys:
+        value = args.get(key)
+        if value is not None and key in ["format", "service", "request", "crs", "srs"]:
+            value = value.lower()
+        normalized[key] = value
+
+    bbox = args.get("bbox")
+    if bbox:
+        try:
+            bbox = [float(b) for b in bbox.split(",")]
+            width, height = float(args["width"]), float(args["height"])
+            tolerance = [
+                bbox_tolerance * abs(bbox[2] - bbox[0]) / width,
+                bbox_tolerance * abs(bbox[3] - bbox[1]) / height,
+            ]
+            # Round to a power-of-two step no larger than the tolerance. The step only depends on the magnitude of the
+            # tolerance and is part of the key, so different extents can never be rounded to the same key.
+            steps = [math.frexp(t)[1] - 1 if t else None for t in tolerance]
+            normalized["bbox"] = [
+                [steps[i % 2], int(round(math.ldexp(b, -steps[i % 2])))] if steps[i % 2] is not None else b
+                for i, b in enumerate(bbox)
+            ]
+        except (KeyError, ValueError, IndexError, ZeroDivisionError):
+            normalized["bbox"] = bbox
+
+    return _hash(layers, definition_hashes, normalized)
+
+
+class RamCache(tl.HasTraits):
+    """In-process LRU cache of `(body, mimetype)` entries with a byte budget"""
+
+    max_bytes = tl.Int(256 * 1024 ** 2)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key --> (group, body, mimetype)
+        self._size = 0
+        self._lock = threading.Lock()
+
+    @property
+    def size(self):
+        return self._size
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1], entry[2]
+
+    def put(self, key, group, body, mimetype):
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            self._pop(key)
+            self._entries[key] = (group, body, mimetype)
+            self._size += len(body)
+            while self._size > self.max_bytes:
+                self._pop(next(iter(self._entries)))
+
+    def invalidate(self, group=None):
+        with self._lock:
+            for key in [k for k, e in self._entries.items() if group is None or e[0] == group]:
+                self._pop(key)
+
+    def _pop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._size -= len(entry[1])
+
+
+class DiskCache(tl.HasTraits):
+    """Local-disk cache with a size budget, evicting the least recently used entries.
+
+    Entries are stored as `<path>/<group hash>/<key>` (the body) and `<key>.json` (metadata, e.g. the mimetype). Files
+    are written atomically, so the cache can be shared by all workers on a host. The workers add the size of their
+    writes to a counter shared on the host (`<path>/.size`, updated under `flock`), and re-scan the directory to evict
+    entries when the budget is exceeded. Removed entries are not subtracted from the counter: it can only overestimate
+    the size of the cache, until the next scan corrects it.
+
+    The budget is capped by the space available on the file system, and the cache evicts entries when the file system
+    is full (e.g. `/dev/shm` of a Docker container is only 64 MB by default).
+    """
+
+    path = tl.Unicode()
+    max_bytes = tl.Int(2 * 1024 ** 3)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.path = os.path.abspath(self.path)
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.path, exist_ok=True)
+        size = self._scan()[0]
+        # The cache can use the space it already holds and the free space of the file system
+        available = size + shutil.disk_usage(self.path).free
+        if self.max_bytes > available:
+            print("Capping the size of the cache {} to {} bytes (space available)".format(self.path, available))
+            self.max_bytes = available
+        with self._shared_size() as counter:
+            counter.set(size)
+
+    def _group_path(self, group):
+        return os.path.join(self.path, _hash(group))
+
+    def _entry_path(self, key, group):
+        return os.path.join(self._group_path(group), key)
+
+    def get_path(self, key, group):
+        """Returns `(path to the body, metadata dict)`, or None if the entry is not cached"""
+        path = self._entry_path(key, group)
+        try:
+            with open(path + ".json", "r") as file:
+                meta = json.load(file)
+            os.utime(path)  # Mark as recently used
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return path, meta
+
+    def open_entry(self, key, group):
+        """Returns `(open binary file of the body, metadata dict)`, or None if the entry is not cached. The open file can
+        still be read if the entry is evicted (by any worker) before it is sent."""
+        entry = self.get_path(key, group)
+        if entry is None:
+            return None
+        try:
+            return open(entry[0], "rb"), entry[1]
+        except OSError:  # evicted in the meantime
+            return None
+
+    def get(self, key, group):
+        """Returns `(body, mimetype)`, or None if the entry is not cached"""
+        entry = self.get_path(key, group)
+        if entry is None:
+            return None
+        try:
+            with open(entry[0], "rb") as file:
+                return file.read(), entry[1].get("mimetype")
+        except OSError:  # evicted in the meantime
+            return None
+
+    def put(self, key, group, body, mimetype, **meta):
+        """Add an entry, returns the path to the cached body"""
+        return self.put_stream(key, group, [body], mimetype, **meta)
+
+    def put_stream(self, key, group, chunks, mimetype, **meta):
+        """Add an entry from an iterable of byte strings, without holding the whole body in memory.
+        Returns the path to the cached body."""
+        path = self._entry_path(key, group)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            size = self._write_entry(path, chunks, mimetype, meta)
+        except OSError as e:
+            if e.errno != errno.ENOSPC:
+                raise
+            # The file system filled up before the budget (e.g. it is shared with other programs): lower the budget,
+            # make room, and try again if the body is still available
+            with self._shared_size() as counter:
+                total = self._scan()[0]
+                if total:
+                    self.max_bytes = min(self.max_bytes, int(total))
+                print("No space left for the cache {}, lowering its size to {} bytes".format(self.path, self.max_bytes))
+                counter.set(self._evict(0.8 * self.max_bytes))
+            if not isinstance(chunks, (list, tuple)):
+                raise
+            size = self._write_entry(path, chunks, mimetype, meta)
+        with self._shared_size() as counter:
+            total = counter.get() + size
+            if total > self.max_bytes:
+                # Evict down to 80% of the budget, so this does not happen on every write
+                total = self._evict(0.8 * self.max_bytes, keep=path)
+            counter.set(total)
+        return path
+
+    @contextlib.contextmanager
+    def _shared_size(self):
+        """Holds the lock of the size counter shared by the workers of the host, see the class documentation"""
+        with open(os.path.join(self.path, ".size"), "a+") as file:
+            fcntl.flock(file, fcntl.LOCK_EX)
+            try:
+                yield _Counter(file)
+            finally:
+                fcntl.flock(file, fcntl.LOCK_UN)
+
+    def _write_entry(self, path, chunks, mimetype, meta):
+        size = self._write(path, chunks)
+        meta = dict(meta, mimetype=mimetype, size=size)
+        try:
+            self._write(path + ".json", [json.dumps(meta).encode("utf8")])
+        except OSError:
+            self._remove(path)
+            raise
+        return size
+
+    def _write(self, path, chunks):
+        tmp = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+        size = 0
+        try:
+            with open(tmp, "wb") as file:
+                for chunk in chunks:
+                    file.write(chunk)
+                    size += len(chunk)
+            os.replace(tmp, path)
+        except BaseException:
+            self._remove(tmp)
+            raise
+        return size
+
+    def _scan(self):
+        """Returns the total size and the list of (last use, size, path) of the cached entries"""
+        entries = []
+        total = 0
+        if not os.path.isdir(self.path):
+            return total, entries
+        for group in os.scandir(self.path):
+            if not group.is_dir():
+                continue
+            for entry in os.scandir(group.path):
+                if entry.name.endswith(".json") or entry.name.endswith(".tmp"):
+                    continue
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, entry.path))
+                total += st.st_size
+        return total, entries
+
+    def _evict(self, target, keep=None):
+        """Evict the least recently used entries until the cache holds at most `target` bytes, returns its size.
+        The entry that was just added (`keep`) is about to be served, so it is never evicted right away, even if it is
+        larger than the budget."""
+        total, entries = self._scan()
+        for _, size, path in sorted(entries):
+            if total <= target:
+                break
+            if path == keep:
+                continue
+            self._remove(path)
+            total -= size
+        return total
+
+    def _remove(self, path):
+        for p in [path + ".json", path]:
+            try:
+                os.remove(p)
+            except OSError:
+                pass
+
+    def invalidate(self, group=None):
+        if not os.path.isdir(self.path):
+            return
+        groups = [self._group_path(group)] if group is not None else [g.path for g in os.scandir(self.path)]
+        for path in groups:
+            if not os.path.isdir(path):
+                continue
+            for entry in os.scandir(path):
+                try:
+                    os.remove(entry.path)
+                except OSError:
+                    pass
+        with self._shared_size() as counter:
+            counter.set(self._scan()[0])
+
+
+class _Counter(object):
+    """Integer stored in an open (locked) file"""
+
+    def __init__(self, file):
+        self.file = file
+
+    def get(self):
+        self.file.seek(0)
+        try:
+            return int(self.file.read() or 0)
+        except ValueError:
+            return 0
+
+    def set(self, value):
+        self.file.seek(0)
+        self.file.truncate()
+        self.file.write(str(int(value)))
+        self.file.flush()
+
+
+class ResponseCache(tl.HasTraits):
+    """Two-tier cache of encoded responses: an in-process LRU in front of an (optional) local-disk cache.
+    Entries are grouped by layer name.
+    """
+
+    ram = tl.Instance(RamCache, allow_none=True)
+    disk = tl.Instance(DiskCache, allow_none=True)
+    bbox_tolerance = tl.Float(0.01)
+
+    def make_key(self, args, layers, definition_hashes, keys):
+        return make_request_key(args, layers, definition_hashes, keys, bbox_tolerance=self.bbox_tolerance)
+
+    def get(self, key, group):
+        """Returns `(body, mimetype)`, or None if the entry is not cached"""
+        entry = self.ram.get(key) if self.ram is not None else None
+        if entry is None and self.disk is not None:
+            entry = self.disk.get(key, group)
+            if entry is not None and self.ram is not None:
+                self.ram.put(key, group, *entry)
+        return entry
+
+    def put(self, key, group, body, mimetype):
+        if self.ram is not None:
+            self.ram.put(key, group, body, mimetype)
+        if self.disk is not None:
+            self.disk.put(key, group, body, mimetype)
+
+    def invalidate(self, group=None, disk=True):
+        """Drop all entries of `group` (a layer name), or everything if `group` is None.
+        The disk tier is shared by all workers on a host, so it only needs to be invalidated once per change.
+        """
+        for tier in [self.ram, self.disk if disk else None]:
+            if tier is not None:
+                tier.invalidate(group)
+
+    @property
+    def hits(self):
+        return sum(tier.hits for tier in [self.ram, self.disk] if tier is not None)
+
+    @property
+    def misses(self):
+        # A request misses if it misses the last tier
+        tiers = [tier for tier in [self.ram, self.disk] if tier is not None]
+        return tiers[-1].misses if tiers else 0
+
+
+class DocumentCache(tl.HasTraits):
+    """Cache of rendered documents (e.g. GetCapabilities and DescribeCoverage XML) for one layer-set fingerprint.
+
+    Each entry holds the body, its precompressed gzip (and, if the `brotli` package is installed, brotli) variants, and
+    an ETag computed from the body, so the ETag is the same on all workers. Entries of other fingerprints are dropped as
+    soon as a document for a new fingerprint is added.
+    """
+
+    max_entries = tl.Int(1000)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.hits = 0
+        self.misses = 0
+        self._fingerprint = None
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, fingerprint, key):
+        """Returns the entry dict (see `put`), or None"""
+        with self._lock:
+            entry = self._entries.get(key) if fingerprint == self._fingerprint else None
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return entry
+
+    def put(self, fingerprint, key, body, mimetype):
+        """Add a document. Returns the entry dict, with the "identity", "gzip", "br" bodies, "mimetype", "etag" and
+        "last_modified" entries."""
+        entry = {
+            "identity": body,
+            "gzip": gzip.compress(body, compresslevel=9),
+            "br": brotli.compress(body) if brotli is not None else None,
+            "mimetype": mimetype,
+            "etag": hashlib.sha1(body).hexdigest(),
+            "last_modified": time.time(),
+        }
+        with self._lock:
+            if fingerprint != self._fingerprint:
+                self._entries.clear()
+                self._fingerprint = fingerprint
+            self._entries[key] = entry
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return entry
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._fingerprint = None
+
+
+class _Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(tl.HasTraits):
+    """Coalesces concurrent identical computations (e.g. renders of the same normalized request).
+
+    The first caller for a key runs the computation, and concurrent callers with the same key wait for it and share its
+    result. If `lock_path` is set, the computation additionally holds a lock file (one of 4096, chosen from the key), so
+    the workers on a host take turns: the computation should then first check a cache that is shared by the workers
+    (e.g. a `DiskCache`), which was filled by the worker that held the lock before.
+    """
+
+    lock_path = tl.Unicode(default_value=None, allow_none=True)
+    timeout = tl.Float(300.0)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if self.lock_path:
+            self.lock_path = os.path.abspath(self.lock_path)
+            os.makedirs(self.lock_path, exist_ok=True)
+        self.coalesced = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    @property
+    def in_flight(self):
+        return len(self._calls)
+
+    def do(self, key, func):
+        """Returns `(func(), shared)`, where `shared` is True if the result was computed by another caller.
+        Errors are raised in all callers. Callers that waited longer than `timeout` seconds run `func` themselves."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            if call.done.wait(self.timeout):
+                if call.error is not None:
+                    raise call.error
+                return call.result, True
+            return func(), False
+
+        try:
+            with self._host_lock(key):
+                call.result = func()
+            return call.result, False
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    @contextlib.contextmanager
+    def _host_lock(self, key):
+        if not self.lock_path:
+            yield
+            return
+        # A fixed set of lock files (removing them after use would race with other workers opening them)
+        with open(os.path.join(self.lock_path, key[:3] + ".lock"), "a") as file:
+            fcntl.flock(file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(file, fcntl.LOCK_UN)
+
+
+def make_response_cache(ram_bytes=256 * 1024 ** 2, disk_path=None, disk_bytes=2 * 1024 ** 3, bbox_tolerance=0.01):
+    """Create a `ResponseCache` from settings. Setting `ram_bytes` to 0 or `disk_path` to None disables that tier."""
+    return ResponseCache(
+        ram=RamCache(max_bytes=int(ram_bytes)) if ram_bytes else None,
+        disk=DiskCache(path=disk_path, max_bytes=int(disk_bytes)) if disk_path else None,
+        bbox_tolerance=bbox_tolerance,
+    )
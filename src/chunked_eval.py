@@ -0,0 +1,107 @@
+"""
+Chunked, concurrent evaluation of large requests (e.g. WCS GetCoverage over CONUS at full resolution).
+
+Large requests are split into spatial chunks that are evaluated concurrently and written into the output array, so the
+intermediate arrays (source data, interpolation buffers) only ever exist for the chunks in progress. Pipelines that
+would give a different result in chunks (see `is_chunkable`) are evaluated at once.
+"""
+import threading
+import concurrent.futures
+
+import traitlets as tl
+
+import podpac
+from podpac.core.utils import NodeTrait
+from podpac.core.algorithm.utility import Arange
+from podpac.core.algorithm.stats import Reduce
+
+# Dimensions that are split into chunks, all other dimensions are evaluated at once
+SPATIAL_DIMS = ["lat", "lon", "x", "y"]
+
+
+class ChunkedEval(podpac.Node):
+    """Evaluates `source` in spatial chunks of (at most) `chunk_size` x `chunk_size` pixels, using `max_workers`
+    threads. Each thread evaluates its own copy of the source, so sources do not have to be thread-safe.
+
+    Attributes
+    ----------
+    source : podpac.Node
+        The node to evaluate
+    chunk_size : int
+        Size of the chunks along each spatial dimension, in pixels
+    max_workers : int
+        Number of chunks evaluated concurrently
+    """
+
+    source = NodeTrait().tag(attr=True)
+    chunk_size = tl.Int(1024).tag(attr=True)
+    max_workers = tl.Int(4).tag(attr=True)
+
+    @tl.default("outputs")
+    def _default_outputs(self):
+        return self.source.outputs
+
+    @tl.default("style")
+    def _default_style(self):
+        return self.source.style
+
+    @tl.default("units")
+    def _default_units(self):
+        return self.source.units
+
+    def find_coordinates(self):
+        return self.source.find_coordinates()
+
+    def chunk_shape(self, coordinates):
+        return [
+            min(self.chunk_size, coordinates[d].size) if d in SPATIAL_DIMS else coordinates[d].size
+            for d in coordinates.dims
+        ]
+
+    def _eval(self, coordinates, output=None, _selector=None):
+        chunks = list(coordinates.iterchunks(self.chunk_shape(coordinates), return_slices=True))
+        if len(chunks) == 1:
+            return self.source.eval(coordinates, output=output, _selector=_selector)
+
+        if output is None:
+            output = self.create_output_array(coordinates)
+        # The chunk slices follow the order of the requested dimensions (writing through the transposed view)
+        target = output.transpose(*(list(coordinates.dims) + [d for d in output.dims if d not in coordinates.dims]))
+        local = threading.local()
+
+        def eval_chunk(chunk):
+            coords, slc = chunk
+            if not hasattr(local, "source"):
+                local.source = podpac.Node.from_definition(self.source.definition)
+            data = local.source.eval(coords, _selector=_selector)
+            target.data[slc] = data.transpose(*target.dims).data
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            # Raises the first error (rather than returning a partially filled coverage)
+            for _ in executor.map(eval_chunk, chunks):
+                pass
+        return output
+
+
+def is_chunkable(node):
+    """False if evaluating `node` in spatial chunks would not give the same result, i.e. if its pipeline contains a
+    node whose output depends on the shape of the request (`Arange`), or that reduces a spatial dimension"""
+    if isinstance(node, Arange):
+        return False
+    if isinstance(node, Reduce) and (node.dims is None or set(node.dims) & set(SPATIAL_DIMS)):
+        return False
+    for value in node._base_definition.get("inputs", {}).values():
+        if isinstance(value, dict):
+            value = list(value.values())
+        elif not isinstance(value, (list, tuple)):
+            value = [value]
+        if any(isinstance(item, podpac.Node) and not is_chunkable(item) for item in value):
+            return False
+    return True
+
+
+def chunk_large_request(node, pixels, max_pixels=None, chunk_size=1024, max_workers=4):
+    """Wrap `node` in a `ChunkedEval` node if the request (`pixels` = width x height) is larger than `max_pixels`"""
+    if not max_pixels or pixels <= max_pixels or not is_chunkable(node):
+        return node
+    return ChunkedEval(source=node, chunk_size=int(chunk_size), max_workers=int(max_workers))
@@ -0,0 +1,203 @@
+"""
+Evaluation cache shared by all workers on a host, registered as the podpac cache store "shared".
+
+podpac's "ram" cache store keeps a copy of the cached outputs in every worker (and every thread). This store keeps them
+once per host instead: entries are files in a `DiskCache` (single byte budget, least recently used entries evicted
+first) that lives in shared memory (`/dev/shm`) by default. Arrays are saved in the `.npy` format and read back as
+copy-on-write memory maps, so reading a cached output does not copy it: the workers share the same pages.
+
+Usage (settings):
+    "DEFAULT_CACHE": ["shared"],
+    "EVAL_CACHE": {"path": "/dev/shm/rpp-eval-cache", "max_bytes": 4E9}
+
+Outputs that could not be cached are counted by the `rpp_eval_cache_put_errors_total` metric.
+"""
+import os
+import io
+import time
+import json
+import pickle
+import base64
+import tempfile
+import threading
+
+import numpy as np
+import xarray as xr
+
+from podpac import settings
+from podpac.core.cache import cache_ctrl
+from podpac.core.cache.cache_store import CacheStore
+from podpac.core.cache.utils import CacheException, CacheWildCard, expiration_timestamp
+
+from caches import DiskCache, _hash
+from metrics import METRICS
+
+PUT_ERRORS = METRICS.counter("rpp_eval_cache_put_errors_total", "Evaluation outputs that could not be cached", ["reason"])
+
+NPY_MIMETYPE = "application/x-npy"
+PICKLE_MIMETYPE = "application/x-python-pickle"
+
+_cache = None
+_cache_lock = threading.Lock()
+_local = threading.local()
+
+
+def default_path():
+    """Shared memory if available (Linux), the temporary directory otherwise (e.g. AWS Lambda has no /dev/shm)"""
+    root = "/dev/shm" if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK) else tempfile.gettempdir()
+    return os.path.join(root, "rpp-eval-cache")
+
+
+def shared_cache():
+    """The `DiskCache` of this process, created from the EVAL_CACHE setting on first use"""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            options = settings.get("EVAL_CACHE") or {}
+            path = os.path.abspath(options.get("path") or default_path())
+            # Entries can be pickles: the directory must not be writable by other users of the host
+            os.makedirs(path, mode=0o700, exist_ok=True)
+            if os.stat(path).st_uid != os.getuid():
+                raise CacheException("The evaluation cache directory {} belongs to another user".format(path))
+            # (the budget is capped by the space available, e.g. /dev/shm is only 64 MB in Docker containers by default)
+            _cache = DiskCache(path=path, max_bytes=int(options.get("max_bytes", 2 * 1024 ** 3)))
+        return _cache
+
+
+def current_cache():
+    """The `DiskCache` of this process, or None if the store was not used yet (e.g. for metrics)"""
+    return _cache
+
+
+class SharedCacheStore(CacheStore):
+    """podpac cache store backed by the host-wide `shared_cache()`.
+
+    Entries are grouped by node hash and keyed by item and coordinates hash. podpac creates a store for every node, so
+    the store itself holds no state.
+    """
+
+    cache_mode = "ram"
+    cache_modes = set(["ram", "all"])
+    _limit_setting = "EVAL_CACHE"
+
+    def __init__(self):
+        self.cache = shared_cache()
+
+    @property
+    def max_size(self):
+        return self.cache.max_bytes
+
+    @property
+    def size(self):
+        return self.cache._scan()[0]
+
+    @staticmethod
+    def _group(node):
+        return node.hash
+
+    @staticmethod
+    def _key(item, coordinates):
+        return _hash(item, coordinates.hash if coordinates is not None else None)
+
+    def put(self, node, data, item, coordinates=None, expires=None, update=True):
+        if not update and self.has(node, item, coordinates):
+            raise CacheException("Cache entry already exists. Use update=True to overwrite.")
+        try:
+            body, mimetype, meta = _encode(data)
+        except Exception:  # e.g. unpicklable data, it is not cached
+            PUT_ERRORS.inc(reason="encode")
+            return False
+        try:
+            self.cache.put(self._key(item, coordinates), self._group(node), body, mimetype,
+                           expires=expiration_timestamp(expires), **meta)
+        except OSError:  # e.g. larger than the space left on the file system, see `DiskCache`
+            PUT_ERRORS.inc(reason="write")
+            return False
+        return True
+
+    def _load(self, node, item, coordinates):
+        """The cached data, or None"""
+        entry = self.cache.get_path(self._key(item, coordinates), self._group(node))
+        if entry is None:
+            return None
+        if entry[1].get("expires") is not None and time.time() >= entry[1]["expires"]:
+            self.cache._remove(entry[0])
+            return None
+        try:
+            return _decode(*entry)
+        except (OSError, ValueError):  # evicted in the meantime
+            return None
+
+    def has(self, node, item, coordinates=None):
+        # podpac calls `has` before `get`: keep the (memory-mapped) data, so an entry evicted in between is still found
+        data = self._load(node, item, coordinates)
+        _local.loaded = (node.hash, item, coordinates, data) if data is not None else None
+        return data is not None
+
+    def get(self, node, item, coordinates=None):
+        loaded = getattr(_local, "loaded", None)
+        _local.loaded = None
+        if loaded is not None and loaded[:2] == (node.hash, item) and loaded[2] is coordinates:
+            return loaded[3]
+        data = self._load(node, item, coordinates)
+        if data is None:
+            raise CacheException("Cache miss. Requested data not found.")
+        return data
+
+    def rem(self, node, item=CacheWildCard(), coordinates=CacheWildCard()):
+        if isinstance(item, CacheWildCard) or isinstance(coordinates, CacheWildCard):
+            self.cache.invalidate(self._group(node))
+            return
+        self.cache._remove(self.cache._entry_path(self._key(item, coordinates), self._group(node)))
+
+    def clear(self):
+        self.cache.invalidate()
+
+    def cleanup(self):
+        """Remove the expired entries"""
+        now = time.time()
+        for _, _, path in self.cache._scan()[1]:
+            try:
+                with open(path + ".json") as file:
+                    expires = json.load(file).get("expires")
+            except (OSError, ValueError):
+                continue
+            if expires is not None and now >= expires:
+                self.cache._remove(path)
+
+
+def _encode(data):
+    """Returns `(body, mimetype, metadata)`. Data arrays are saved as `.npy` and their coordinates, dimensions and
+    attributes in the metadata, anything else is pickled."""
+    if isinstance(data, xr.DataArray) and data.dtype != object:
+        file = io.BytesIO()
+        np.save(file, np.ascontiguousarray(data.values), allow_pickle=False)
+        skeleton = {
+            "class": type(data),
+            "dims": data.dims,
+            "coords": {k: (c.dims, c.values, c.attrs) for k, c in data.coords.items()},
+            "attrs": data.attrs,
+            "name": data.name,
+        }
+        return file.getvalue(), NPY_MIMETYPE, {"skeleton": base64.b64encode(pickle.dumps(skeleton)).decode("ascii")}
+    return pickle.dumps(data), PICKLE_MIMETYPE, {}
+
+
+def _decode(path, meta):
+    if meta.get("mimetype") != NPY_MIMETYPE:
+        with open(path, "rb") as file:
+            return pickle.load(file)
+    # Copy-on-write: the pages are shared with the other workers until (unless) the array is modified
+    values = np.load(path, mmap_mode="c", allow_pickle=False)
+    skeleton = pickle.loads(base64.b64decode(meta["skeleton"]))
+    data = xr.DataArray(values, coords=skeleton["coords"], dims=skeleton["dims"], attrs=skeleton["attrs"],
+                        name=skeleton["name"])
+    if skeleton["class"] is not xr.DataArray:
+        data = skeleton["class"](data)
+    return data
+
+
+def register():
+    """Make the store available to podpac as "shared" (e.g. in the DEFAULT_CACHE setting, or `cache_ctrl=["shared"]`)"""
+    cache_ctrl._CACHE_STORES["shared"] = SharedCacheStore
+    cache_ctrl._CACHE_NAMES[SharedCacheStore] = "shared"
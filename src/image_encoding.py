@@ -0,0 +1,165 @@
+"""
+Fast path for the PNG images of WMS GetMap requests.
+
+podpac's `to_image` colors the data with matplotlib and saves an RGBA PNG through `imsave`. This module applies the
+colormap of the layer style with a lookup table (cached per style) and writes the PNG itself, with a palette (one byte
+per pixel instead of four) whenever the image uses at most 256 colors, which is several times faster. The pixels are
+identical to podpac's: the lookup table is read from the same matplotlib colormap, and the data are binned the same way.
+
+Images that the fast path does not handle (other formats, data that are not a single 2D image, colormaps that are not
+matplotlib colormaps) are rendered by podpac's `to_image`.
+"""
+import io
+import zlib
+import base64
+import struct
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import xarray as xr
+import matplotlib.colors
+
+import podpac.core.units
+from podpac.core.style import Style
+
+# podpac's implementation, used as the fallback
+podpac_to_image = podpac.core.units.to_image
+
+_luts = OrderedDict()
+_luts_lock = threading.Lock()
+MAX_LUTS = 256
+COMPRESS_LEVEL = 6
+
+
+def colormap_lut(style):
+    """Returns the RGBA lookup table (uint8, N + 3 rows: the N colors, under, over, and transparent bad values) of the
+    colormap of `style`, or None if it is not a matplotlib colormap"""
+    key = style.json if style is not None else None
+    with _luts_lock:
+        if key in _luts:
+            _luts.move_to_end(key)
+            return _luts[key]
+
+    cmap = style.cmap if style is not None else matplotlib.cm.get_cmap("viridis")
+    if not isinstance(cmap, matplotlib.colors.Colormap):
+        lut = None
+    else:
+        lut = np.concatenate([
+            cmap(np.arange(cmap.N), bytes=True),
+            cmap(np.array([-1.0, 2.0, np.nan]), bytes=True),  # under, over, bad
+        ])
+        lut[-1, 3] = 0  # podpac makes missing data transparent
+
+    with _luts_lock:
+        _luts[key] = lut
+        while len(_luts) > MAX_LUTS:
+            _luts.popitem(last=False)
+    return lut
+
+
+def colormap_indices(data, vmin, vmax, n):
+    """Rows of the lookup table for `data`, binned like `matplotlib.colors.Colormap.__call__`"""
+    with np.errstate(invalid="ignore", divide="ignore", over="ignore"):
+        x = (data - vmin) / (vmax - vmin)
+        bad = np.isnan(x)
+        x *= n
+        x[x < 0] = -1
+        x[x == n] = n - 1  # vmax belongs to the last color
+        np.clip(x, -1, n, out=x)
+        indices = x.astype(np.intp)
+    indices[indices > n - 1] = n + 1
+    indices[indices < 0] = n
+    indices[bad] = n + 2
+    return indices
+
+
+def encode_png(indices, lut, compress_level=None):
+    """PNG of the image `lut[indices]`, with a palette if it uses at most 256 colors"""
+    lut32 = np.ascontiguousarray(lut).view(np.uint32).ravel()  # one RGBA color per item
+    used = np.flatnonzero(np.bincount(indices.ravel(), minlength=len(lut)))
+    colors, inverse = np.unique(lut32[used], return_inverse=True)
+    if len(colors) <= 256:
+        table = np.zeros(len(lut), np.uint8)
+        table[used] = inverse.ravel()
+        rgba = colors.view(np.uint8).reshape(-1, 4)
+        chunks = [_chunk(b"PLTE", rgba[:, :3].tobytes())]
+        if (rgba[:, 3] < 255).any():
+            chunks.append(_chunk(b"tRNS", rgba[:, 3].tobytes()))
+        return _png(table[indices], 3, chunks, compress_level)
+    pixels = lut32[indices].view(np.uint8).reshape(indices.shape + (4,))
+    return _png(pixels, 6, [], compress_level)
+
+
+def _png(pixels, color_type, chunks, compress_level):
+    """8-bit PNG of `pixels` (rows x columns [x channels]). The scanlines are not filtered: it is faster, and the images
+    (smooth colormaps, palette images) compress well without."""
+    height, width = pixels.shape[:2]
+    scanlines = np.empty((height, 1 + pixels[0].size), np.uint8)
+    scanlines[:, 0] = 0  # filter type None
+    scanlines[:, 1:] = pixels.reshape(height, -1)
+    level = COMPRESS_LEVEL if compress_level is None else compress_level
+    header = struct.pack(">IIBBBBB", width, height, 8, color_type, 0, 0, 0)
+    buffer = io.BytesIO()
+    buffer.write(b"\x89PNG\r\n\x1a\n")
+    for chunk in [_chunk(b"IHDR", header)] + chunks + [_chunk(b"IDAT", zlib.compress(scanlines, level))]:
+        buffer.write(chunk)
+    buffer.write(_chunk(b"IEND", b""))
+    buffer.seek(0)
+    return buffer
+
+
+def _chunk(tag, data):
+    return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data))
+
+
+def to_image(data, format="png", vmin=None, vmax=None, return_base64=False):
+    """Drop-in replacement for `podpac.core.units.to_image`, see the module documentation"""
+    image = _fast_to_image(data, format, vmin, vmax)
+    if image is None:
+        return podpac_to_image(data, format, vmin, vmax, return_base64)
+    if return_base64:
+        return base64.b64encode(image.getvalue())
+    return image
+
+
+def _fast_to_image(data, format, vmin, vmax):
+    if format != "png" or not isinstance(data, xr.DataArray) or data.dtype.kind not in "fiu":
+        return None
+    dims = data.squeeze().dims
+    # podpac flips the first axis of the (unsqueezed) data: only handle data where it is the image's y axis
+    if len(dims) != 2 or tuple(data.dims[:2]) != dims or min(data.shape[:2]) < 2:
+        return None
+
+    style = data.attrs.get("layer_style", None)
+    if isinstance(style, str):
+        style = Style.from_json(style)
+    lut = colormap_lut(style)
+    if lut is None:
+        return None
+
+    y = data.coords[dims[0]].values  # (comparing xarray coordinates is much slower)
+    values = data.data.reshape(data.shape[:2])
+    if y[1] > y[0]:
+        values = values[::-1, :]
+    values = np.asarray(values, dtype=float) if data.dtype.kind != "f" else values
+
+    # Color limits, as in podpac
+    if not np.any(np.isfinite(values)):
+        vmin, vmax = 0, 1
+    else:
+        if vmin is None or np.isnan(vmin):
+            vmin = style.clim[0] if style is not None and style.clim[0] != None else np.nanmin(values)
+        if vmax is None or np.isnan(vmax):
+            vmax = style.clim[1] if style is not None and style.clim[1] != None else np.nanmax(values)
+    if vmax == vmin:
+        vmax += 1e-15
+
+    return encode_png(colormap_indices(values, vmin, vmax, len(lut) - 3), lut)
+
+
+def install(compress_level=6):
+    """Use the fast path for all podpac images (`UnitsDataArray.to_image` calls `podpac.core.units.to_image`)"""
+    global COMPRESS_LEVEL
+    COMPRESS_LEVEL = int(compress_level)
+    podpac.core.units.to_image = to_image
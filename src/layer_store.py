@@ -0,0 +1,371 @@
+"""
+Storage backends for the published layers.
+
+Each published layer is stored as `name --> item`, where `item` is a dictionary with (at least) the
+`author_key`, `definition`, and `expiration` entries (see `publishing_api.publish_pipeline`).
+"""
+import os
+import abc
+import json
+import fcntl
+import contextlib
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import traitlets as tl
+
+from podpac.core.authentication import S3Mixin
+
+from metrics import METRICS
+
+READ_BYTES = METRICS.counter("rpp_layer_store_read_bytes_total", "Bytes read from the layer store", ["backend"])
+
+
+def make_layer_store(source, **kwargs):
+    """Create the layer store backend appropriate for `source`
+
+    Parameters
+    ----------
+    source : str
+        Path to the layer store. Paths ending in `.sqlite`, `.sqlite3`, or `.db` use the SQLite backend, everything
+        else (including `s3://` paths) uses the JSON document backend.
+    **kwargs
+        Passed on to the backend
+
+    Returns
+    -------
+    LayerStore
+    """
+    if os.path.splitext(source)[1].lower() in [".sqlite", ".sqlite3", ".db"]:
+        return SQLiteLayerStore(source=source, **kwargs)
+    return JSONLayerStore(source=source, **kwargs)
+
+
+class _ABCMetaHasTraits(abc.ABCMeta, tl.MetaHasTraits):
+    """Metaclass of the abstract `HasTraits` classes"""
+
+
+class LayerStore(tl.HasTraits, metaclass=_ABCMetaHasTraits):
+    """Base class for the layer store backends"""
+
+    source = tl.Unicode()
+
+    def stamp(self):
+        """Cheap identifier of the current state of the store, without reading its content.
+        Returns None if the state cannot be determined, in which case the store has to be re-loaded.
+        """
+        return None
+
+    @abc.abstractmethod
+    def load(self):
+        """Returns an OrderedDict with all the published layers"""
+
+    def get(self, key, default=None):
+        return self.load().get(key, default)
+
+    @abc.abstractmethod
+    def set(self, key, item):
+        """Add or replace layer `key`"""
+
+    @abc.abstractmethod
+    def remove(self, key):
+        """Remove layer `key`"""
+
+    @abc.abstractmethod
+    def update(self, layers):
+        """Replace all of the published layers with `layers`"""
+
+    def query(self, author_key):
+        """Returns an OrderedDict with all the layers published using `author_key`"""
+        return OrderedDict((k, v) for k, v in self.load().items() if v.get("author_key") == author_key)
+
+    def version(self):
+        """Monotonically increasing counter shared by all processes using this store, incremented by every write.
+        Returns None if the store does not keep track of its changes.
+        """
+        return None
+
+    def changes(self, since):
+        """Returns the layers that changed after version `since` of the store.
+
+        Parameters
+        ----------
+        since : int
+            Version of the store, as returned by `version`
+
+        Returns
+        -------
+        tuple or None
+            `(version, OrderedDict(name --> item))`, where `item` is None for removed layers. Returns None when the
+            changes are not known, e.g. when the store was modified outside of this class, in which case the whole
+            store has to be re-loaded.
+        """
+        return None
+
+
+class JSONLayerStore(LayerStore):
+    """Stores all layers in a single JSON document, on the local file system or S3.
+    Every write rewrites the whole document. Writes from workers on the same host are serialized using a lock file,
+    but concurrent writes on S3 can still overwrite each other (use `SQLiteLayerStore` instead).
+    """
+
+    s3 = tl.Any()
+    s3_check_interval = tl.Float(5.0)
+    max_changes = tl.Int(100)
+    _s3_stamp = tl.Any(default_value=None, allow_none=True)
+    _s3_checked = tl.Float(0)
+
+    @tl.default("s3")
+    def _default_s3(self):
+        return (
+            S3Mixin().s3
+        )  # This will automatically pull credentials from aws config OR podpac settings
+
+    def stamp(self):
+        """Local files are identified using stat (mtime + size + inode), S3 objects using their ETag.
+        The ETag is checked at most every `s3_check_interval` seconds.
+        """
+        if self.source.startswith("s3://"):
+            now = time.time()
+            if self._s3_stamp is None or now - self._s3_checked >= self.s3_check_interval:
+                self.s3.invalidate_cache(self.source)  # s3fs caches object info, we need a fresh HEAD request
+                info = self.s3.info(self.source)
+                self._s3_stamp = (info.get("ETag"), info.get("size"))
+                self._s3_checked = now
+            return self._s3_stamp
+        st = os.stat(self.source)
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def load(self):
+        try:
+            return json.loads(self._read(self.source), object_pairs_hook=OrderedDict)
+        except:
+            if not self.source.startswith("s3://") and not os.path.exists(self.source):
+                open(self.source, "w").write(json.dumps({}))
+            return OrderedDict()
+
+    def set(self, key, item):
+        with self._lock():
+            layers = self.load()
+            layers[key] = item
+            self._update(layers, [key])
+
+    def remove(self, key):
+        with self._lock():
+            layers = self.load()
+            del layers[key]
+            self._update(layers, [key])
+
+    def update(self, layers):
+        with self._lock():
+            self._update(layers, None)
+
+    def _update(self, layers, keys):
+        self._write(self.source, json.dumps(layers))
+        self._s3_stamp = None
+        self._log_changes(keys)
+
+    # The changes are logged in a small sidecar document next to the layers document, so other workers can find out
+    # which layers changed without comparing the full document:
+    #   {"version": <int>, "changes": [[<version>, <name or null if everything changed>], ...]}
+
+    @property
+    def _changes_source(self):
+        return self.source + ".version"
+
+    def _read_changes(self):
+        try:
+            return json.loads(self._read(self._changes_source))
+        except:
+            return None
+
+    def _log_changes(self, keys):
+        log = self._read_changes() or {"version": 0, "changes": []}
+        for key in keys or [None]:
+            log["version"] += 1
+            log["changes"].append([log["version"], key])
+        log["changes"] = log["changes"][-self.max_changes:]
+        self._write(self._changes_source, json.dumps(log))
+
+    def version(self):
+        log = self._read_changes()
+        return None if log is None else log["version"]
+
+    def changes(self, since):
+        log = self._read_changes()
+        # If the document changed but no change was logged, it was modified outside of this class
+        if log is None or since is None or log["version"] <= since:
+            return None
+        keys = [key for version, key in log["changes"] if version > since]
+        if len(keys) != log["version"] - since or None in keys:
+            return None
+        layers = self.load()
+        return log["version"], OrderedDict((key, layers.get(key)) for key in keys)
+
+    def _read(self, path):
+        if path.startswith("s3://"):
+            data = self.s3.open(path, "r").read()
+        else:
+            data = open(path, "r").read()
+        READ_BYTES.inc(len(data), backend="json")
+        return data
+
+    def _write(self, path, data):
+        if path.startswith("s3://"):
+            with self.s3.open(path, "w") as file:
+                file.write(data)
+        else:
+            # Other workers read the document without the lock: replace it atomically, so they never see a partial one
+            tmp = "{}.{}.tmp".format(path, os.getpid())
+            with open(tmp, "w") as file:
+                file.write(data)
+            os.replace(tmp, path)
+
+    @contextlib.contextmanager
+    def _lock(self):
+        """Serialize read-modify-write cycles of the local workers. There is no equivalent for S3."""
+        if self.source.startswith("s3://"):
+            yield
+            return
+        with open(self.source + ".lock", "a") as file:
+            fcntl.flock(file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(file, fcntl.LOCK_UN)
+
+
+class SQLiteLayerStore(LayerStore):
+    """Stores one row per layer in a SQLite database, indexed by name and `author_key`.
+    Writes are single-row transactions, so concurrent publishes from multiple workers do not overwrite each other.
+
+    The `meta` table holds a `version` counter that is incremented by every write, which is used as the stamp.
+    The `changes` table logs which layer was changed by each version (the last `max_changes` are kept).
+    """
+
+    migrate_from = tl.Unicode(default_value=None, allow_none=True)
+    timeout = tl.Float(30.0)
+    max_changes = tl.Int(1000)
+    _local = tl.Instance(threading.local, args=())
+
+    @property
+    def _connection(self):
+        # sqlite3 connections can neither be shared between threads nor survive a fork (gunicorn workers)
+        local = self._local
+        if getattr(local, "pid", None) != os.getpid():
+            local.connection = self._connect()
+            local.pid = os.getpid()
+        return local.connection
+
+    def _connect(self):
+        if os.path.dirname(self.source):
+            os.makedirs(os.path.dirname(self.source), exist_ok=True)
+        connection = sqlite3.connect(self.source, timeout=self.timeout, isolation_level=None)
+        connection.execute("PRAGMA journal_mode=WAL")
+        with _transaction(connection):
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS layers (name TEXT PRIMARY KEY, author_key TEXT, item TEXT NOT NULL)"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS layers_author_key ON layers (author_key)")
+            connection.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER)")
+            connection.execute("CREATE TABLE IF NOT EXISTS changes (version INTEGER PRIMARY KEY, name TEXT)")
+            created = connection.execute("INSERT OR IGNORE INTO meta VALUES ('version', 0)").rowcount
+            if created and self.migrate_from:
+                self._migrate(connection, JSONLayerStore(source=self.migrate_from).load())
+        return connection
+
+    def _migrate(self, connection, layers):
+        print("Migrating {} layers from {} to {}".format(len(layers), self.migrate_from, self.source))
+        for key, item in layers.items():
+            self._write(connection, key, item)
+
+    def _write(self, connection, key, item):
+        # Not using INSERT OR REPLACE (changes the rowid, i.e. the order) or UPSERT (not available on older sqlite)
+        values = (item.get("author_key"), json.dumps(item), key)
+        if connection.execute("UPDATE layers SET author_key = ?, item = ? WHERE name = ?", values).rowcount == 0:
+            connection.execute("INSERT INTO layers (author_key, item, name) VALUES (?, ?, ?)", values)
+        self._log_change(connection, key)
+
+    def _log_change(self, connection, key):
+        connection.execute("UPDATE meta SET value = value + 1 WHERE key = 'version'")
+        version = connection.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()[0]
+        connection.execute("INSERT INTO changes VALUES (?, ?)", (version, key))
+        connection.execute("DELETE FROM changes WHERE version <= ?", (version - self.max_changes,))
+
+    def stamp(self):
+        return self.version()
+
+    def version(self):
+        return self._connection.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()[0]
+
+    def changes(self, since):
+        if since is None:
+            return None
+        with _transaction(self._connection, "BEGIN"):  # consistent snapshot
+            version = self.version()
+            rows = self._connection.execute("SELECT version, name FROM changes WHERE version > ?", (since,)).fetchall()
+            names = [name for _, name in rows]
+            if len(rows) != version - since or None in names:
+                return None
+            return version, OrderedDict((name, self.get(name)) for name in names)
+
+    def load(self):
+        rows = self._connection.execute("SELECT name, item FROM layers ORDER BY rowid")
+        return self._decode(rows)
+
+    def get(self, key, default=None):
+        row = self._connection.execute("SELECT item FROM layers WHERE name = ?", (key,)).fetchone()
+        if row is None:
+            return default
+        READ_BYTES.inc(len(row[0]), backend="sqlite")
+        return json.loads(row[0], object_pairs_hook=OrderedDict)
+
+    def _decode(self, rows):
+        layers = OrderedDict()
+        size = 0
+        for name, item in rows:
+            layers[name] = json.loads(item, object_pairs_hook=OrderedDict)
+            size += len(item)
+        READ_BYTES.inc(size, backend="sqlite")
+        return layers
+
+    def set(self, key, item):
+        connection = self._connection
+        with _transaction(connection):
+            self._write(connection, key, item)
+
+    def remove(self, key):
+        connection = self._connection
+        with _transaction(connection):
+            if connection.execute("DELETE FROM layers WHERE name = ?", (key,)).rowcount == 0:
+                raise KeyError(key)
+            self._log_change(connection, key)
+
+    def update(self, layers):
+        connection = self._connection
+        with _transaction(connection):
+            connection.execute("DELETE FROM layers")
+            for key, item in layers.items():
+                self._write(connection, key, item)
+            self._log_change(connection, None)
+
+    def query(self, author_key):
+        rows = self._connection.execute("SELECT name, item FROM layers WHERE author_key = ? ORDER BY rowid", (author_key,))
+        return self._decode(rows)
+
+
+class _transaction(object):
+    """Context manager for a transaction (write-locked by default) on an autocommit sqlite3 connection"""
+
+    def __init__(self, connection, begin="BEGIN IMMEDIATE"):
+        self.connection = connection
+        self.begin = begin
+
+    def __enter__(self):
+        self.connection.execute(self.begin)
+        return self.connection
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.connection.execute("COMMIT" if exc_type is None else "ROLLBACK")
@@ -0,0 +1,293 @@
+"""
+Lightweight Prometheus-style metrics (counters and histograms), aggregated across the gunicorn workers of a host.
+
+Each worker keeps its metrics in memory (an update is a dictionary update under a lock), and writes a snapshot to
+`<path>/metrics.<pid>.json` at most every `flush_interval` seconds. The metrics endpoint sums the snapshots of all the
+workers, so it reports host-wide values whichever worker serves it. Without a `path`, only the metrics of the serving
+worker are reported. The snapshots of workers that exited are removed, so the counters of a host drop when workers are
+replaced (which Prometheus handles as a counter reset).
+
+Usage:
+    REQUESTS = METRICS.counter("rpp_requests_total", "Requests", ["route"])
+    REQUESTS.inc(route="/api/")
+    with METRICS.histogram("rpp_render_seconds", "Render time", ["layer"]).time(layer="SoilMoisture"):
+        ...
+"""
+import os
+import json
+import time
+import glob
+import threading
+import contextlib
+from collections import OrderedDict
+
+import traitlets as tl
+
+DEFAULT_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0]
+
+
+class Counter(object):
+    type = "counter"
+
+    def __init__(self, registry, name, help, labels):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+
+    def _key(self, labels):
+        return tuple(str(labels.get(label, "")) for label in self.labels)
+
+    def inc(self, value=1, **labels):
+        self.registry._check_fork()
+        key = self._key(labels)
+        with self.registry._lock:
+            self.values[key] = self.values.get(key, 0) + value
+        self.registry._maybe_flush()
+
+
+class Histogram(Counter):
+    """Histogram with fixed buckets. Values are stored as (per-bucket counts + [+Inf count], sum, count)."""
+
+    type = "histogram"
+
+    def __init__(self, registry, name, help, labels, buckets=None):
+        super().__init__(registry, name, help, labels)
+        self.buckets = list(buckets or DEFAULT_BUCKETS)
+
+    def observe(self, value, **labels):
+        self.registry._check_fork()
+        key = self._key(labels)
+        i = next((i for i, b in enumerate(self.buckets) if value <= b), len(self.buckets))
+        with self.registry._lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][i] += 1
+            entry[1] += value
+            entry[2] += 1
+        self.registry._maybe_flush()
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start, **labels)
+
+
+class Metrics(tl.HasTraits):
+    """Registry of the metrics of a worker, see the module documentation
+
+    Attributes
+    ----------
+    path : str
+        Directory for the per-worker snapshots, shared by all workers on the host. None to only report this worker.
+    flush_interval : float
+        Minimum time between two snapshots of a worker, in seconds
+    """
+
+    path = tl.Unicode(default_value=None, allow_none=True)
+    flush_interval = tl.Float(5.0)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._metrics = OrderedDict()
+        self._collectors = []
+        self._gauges = []
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._flushed = 0
+
+    def counter(self, name, help, labels=()):
+        return self._register(Counter(self, name, help, list(labels)))
+
+    def histogram(self, name, help, labels=(), buckets=None):
+        return self._register(Histogram(self, name, help, list(labels), buckets))
+
+    def _register(self, metric):
+        if metric.name in self._metrics:
+            return self._metrics[metric.name]
+        self._metrics[metric.name] = metric
+        return metric
+
+    def collector(self, func):
+        """Register `func()`, returning a list of `(name, help, labels dict, value)` counters kept elsewhere by this
+        worker (e.g. the hits and misses of the caches). They are included in the snapshots and summed over workers."""
+        self._collectors.append(func)
+        return func
+
+    def gauge(self, func):
+        """Register `func()`, returning a list of `(name, help, labels dict, value)` gauges. They are evaluated by the
+        worker serving the metrics, and should describe the whole host (e.g. the number of requests queued)."""
+        self._gauges.append(func)
+        return func
+
+    def snapshot(self):
+        """JSON-serializable state of this worker"""
+        metrics = {}
+        with self._lock:
+            for metric in self._metrics.values():
+                entry = {"type": metric.type, "help": metric.help, "labels": metric.labels, "values": []}
+                if metric.type == "histogram":
+                    entry["buckets"] = metric.buckets
+                    entry["values"] = [[list(k), [list(v[0]), v[1], v[2]]] for k, v in metric.values.items()]
+                else:
+                    entry["values"] = [[list(k), v] for k, v in metric.values.items()]
+                metrics[metric.name] = entry
+        for func in self._collectors:
+            try:
+                items = func()
+            except Exception as e:
+                print("Metrics collector failed:", e)
+                continue
+            for name, help, labels, value in items:
+                entry = metrics.setdefault(
+                    name, {"type": "counter", "help": help, "labels": sorted(labels), "values": []}
+                )
+                entry["values"].append([[str(labels[k]) for k in entry["labels"]], value])
+        return metrics
+
+    def _check_fork(self):
+        # Workers forked from a process that already recorded metrics (e.g. gunicorn --preload) start from zero
+        if os.getpid() != self._pid:
+            with self._lock:
+                if os.getpid() != self._pid:
+                    for metric in self._metrics.values():
+                        metric.values.clear()
+                    self._pid = os.getpid()
+                    self._flushed = 0
+
+    def _maybe_flush(self):
+        if self.path and time.time() - self._flushed >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """Write the snapshot of this worker"""
+        self._check_fork()
+        self._flushed = time.time()
+        if not self.path:
+            return
+        os.makedirs(self.path, exist_ok=True)
+        path = os.path.join(self.path, "metrics.{}.json".format(os.getpid()))
+        tmp = "{}.{}.tmp".format(path, threading.get_ident())
+        try:
+            with open(tmp, "w") as file:
+                json.dump(self.snapshot(), file)
+            os.replace(tmp, path)
+        except OSError as e:
+            print("Could not write the metrics snapshot:", e)
+
+    def collect(self):
+        """Sum of the snapshots of all workers (or only of this worker, without a `path`)"""
+        self._check_fork()
+        if not self.path:
+            return self.snapshot()
+        self.flush()
+        total = {}
+        for path in glob.glob(os.path.join(self.path, "metrics.*.json")):
+            if not _alive(path):
+                # Worker that exited (e.g. recycled by gunicorn's max_requests)
+                _remove(path)
+                continue
+            try:
+                with open(path) as file:
+                    snapshot = json.load(file)
+            except (OSError, ValueError):
+                continue
+            for name, entry in snapshot.items():
+                _merge(total, name, entry)
+        return total
+
+    def render(self):
+        """Prometheus text exposition format"""
+        lines = []
+        metrics = self.collect()
+        for func in self._gauges:
+            try:
+                items = func()
+            except Exception as e:
+                print("Metrics gauge failed:", e)
+                continue
+            for name, help, labels, value in items:
+                entry = metrics.setdefault(name, {"type": "gauge", "help": help, "labels": sorted(labels), "values": []})
+                entry["values"].append([[str(labels[k]) for k in entry["labels"]], value])
+
+        for name, entry in metrics.items():
+            lines.append("# HELP {} {}".format(name, entry["help"]))
+            lines.append("# TYPE {} {}".format(name, entry["type"]))
+            for key, value in entry["values"]:
+                labels = list(zip(entry["labels"], key))
+                if entry["type"] != "histogram":
+                    lines.append("{}{} {}".format(name, _labels(labels), _number(value)))
+                    continue
+                counts, sum_, count = value
+                cumulative = 0
+                for bound, n in zip(entry["buckets"] + ["+Inf"], counts):
+                    cumulative += n
+                    le = bound if bound == "+Inf" else _number(bound)
+                    lines.append("{}_bucket{} {}".format(name, _labels(labels + [("le", le)]), cumulative))
+                lines.append("{}_sum{} {}".format(name, _labels(labels), _number(sum_)))
+                lines.append("{}_count{} {}".format(name, _labels(labels), count))
+        return "\n".join(lines) + "\n"
+
+
+def _alive(path):
+    """False if the worker that wrote the snapshot `path` (metrics.<pid>.json) is not running anymore"""
+    try:
+        pid = int(os.path.basename(path).split(".")[1])
+    except ValueError:
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:  # running as another user
+        pass
+    return True
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _merge(total, name, entry):
+    current = total.get(name)
+    if current is None:
+        total[name] = current = dict(entry, values=[])
+    elif current["labels"] != entry["labels"] or current.get("buckets") != entry.get("buckets"):
+        return  # snapshot of an older version of the server
+    values = OrderedDict((tuple(k), v) for k, v in current["values"])
+    for key, value in entry["values"]:
+        key = tuple(key)
+        if key not in values:
+            values[key] = value
+        elif entry["type"] == "histogram":
+            old = values[key]
+            values[key] = [[a + b for a, b in zip(old[0], value[0])], old[1] + value[1], old[2] + value[2]]
+        else:
+            values[key] = values[key] + value
+    current["values"] = [[list(k), v] for k, v in values.items()]
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, _escape(v)) for k, v in labels) + "}"
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# Metrics of this worker, configured by the server (see the METRICS setting)
+METRICS = Metrics()
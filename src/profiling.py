@@ -0,0 +1,98 @@
+"""
+Opt-in profiling of single requests.
+
+A profiled request runs under cProfile, and records the time spent in the main phases of the server (`span`). The
+breakdown also includes the podpac phases found in the cProfile statistics (see `PODPAC_PHASES`). When no request is
+being profiled, `span` only costs a thread-local lookup.
+"""
+import os
+import json
+import time
+import pstats
+import cProfile
+import threading
+import contextlib
+
+_local = threading.local()
+
+# Phase name --> list of (path fragment, function name) of the functions whose cumulative time is reported. When several
+# functions match (e.g. the `get_data` of the different data sources), the largest cumulative time is used, since they
+# usually call each other. GetMap images are encoded by `image_encoding.to_image` once it replaced podpac's `to_image`.
+PODPAC_PHASES = {
+    "node_from_definition": [("podpac/core/node.py", "from_definition")],
+    "find_coordinates": [("podpac/core/", "find_coordinates")],
+    "eval": [("podpac/core/node.py", "eval")],
+    "data_io": [("podpac/core/data/", "get_data")],
+    "interpolation": [("podpac/core/interpolation/interpolation_manager.py", "interpolate")],
+    "image_encoding": [("podpac/core/units.py", "to_image"), ("image_encoding.py", "to_image")],
+}
+
+
+class Profile(object):
+    """Profile of one request: cProfile statistics and the total time spent in each span"""
+
+    def __init__(self):
+        self.spans = {}
+        self.start = time.time()
+        self.duration = None
+        self.profiler = cProfile.Profile()
+
+    def __enter__(self):
+        _local.profile = self
+        self.profiler.enable()
+        return self
+
+    def __exit__(self, *args):
+        self.profiler.disable()
+        self.duration = time.time() - self.start
+        _local.profile = None
+
+    def add(self, name, seconds):
+        self.spans[name] = self.spans.get(name, 0.0) + seconds
+
+    def breakdown(self):
+        """Phase name --> seconds, for the spans and the podpac phases"""
+        breakdown = {"total": self.duration}
+        breakdown.update(self.spans)
+        stats = pstats.Stats(self.profiler).stats
+        for phase, functions in PODPAC_PHASES.items():
+            seconds = max(
+                [
+                    cumulative for (path, _, name), (_, _, _, cumulative, _) in stats.items()
+                    if any(name == function and fragment in path.replace(os.sep, "/") for fragment, function in functions)
+                ],
+                default=0,
+            )
+            if seconds:
+                breakdown[phase] = seconds
+        return breakdown
+
+    def server_timing(self):
+        """Breakdown as a Server-Timing header value (durations in ms)"""
+        return ", ".join("{};dur={:.1f}".format(name, seconds * 1000) for name, seconds in self.breakdown().items())
+
+    def dump(self, path, name):
+        """Save the cProfile statistics (`<name>.pstats`, e.g. for flamegraphs) and the breakdown (`<name>.json`)"""
+        os.makedirs(path, exist_ok=True)
+        self.profiler.dump_stats(os.path.join(path, name + ".pstats"))
+        with open(os.path.join(path, name + ".json"), "w") as file:
+            json.dump(self.breakdown(), file, indent=2)
+
+
+def current():
+    """The profile of the request handled by this thread, or None"""
+    return getattr(_local, "profile", None)
+
+
+@contextlib.contextmanager
+def span(name):
+    """Record the time spent in the block if the current request is profiled"""
+    profile = getattr(_local, "profile", None)
+    if profile is None:
+        yield
+        return
+    start = time.time()
+    try:
+        yield
+    finally:
+        profile.add(name, time.time() - start)
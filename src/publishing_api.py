@@ -7,6 +7,7 @@ import podpac
 from podpac import settings
 
 from utils import _string_to_html
+from server_layers import make_layer_metadata
 
 def publish_pipeline(url, LAYERS):
     """
@@ -99,12 +100,20 @@ def publish_pipeline(url, LAYERS):
             }
             return response
 
+        try:
+            metadata = make_layer_metadata(n)
+        except Exception as e:
+            # The metadata will be computed when the layer is loaded instead
+            print("Could not compute metadata for pipeline `{}`:".format(name), e)
+            metadata = None
+
         LAYERS.set(
             name,
             {
                 "author_key": url_key,
                 "definition": n.definition,
                 "expiration": url.get("Expires", [None])[0],
+                "metadata": metadata,
             },
         )
         response = {"status": "Success", "message": message.format(name=name)}
@@ -178,7 +187,7 @@ def query_pipeline(url, LAYERS):
                 {
                     "message": "Returning all pipelines defined using the provided secret key.",
                     "pipelines": {
-                        k: v["definition"] for k, v in layers.items() if v["author_key"] == url_key
+                        k: v["definition"] for k, v in LAYERS.query(url_key).items()
                     },
                 }
             )
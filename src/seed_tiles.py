@@ -0,0 +1,151 @@
+"""
+Pre-render the XYZ tiles of a published layer into the GetMap cache.
+
+Tiles are rendered through the `api/tiles` endpoint of the server app (in-process, without network), in a pool of
+worker processes. Only the disk tier of the GetMap cache is shared with the running server, so it has to be enabled
+(`GETMAP_CACHE.disk_path` in the settings).
+
+Examples
+--------
+Estimate the number of tiles:
+    python seed_tiles.py SoilMoisture --bbox -125 24 -66 50 --zoom 0 8 --time 2023-05-01 --dry-run
+Seed them with 8 processes, recording progress so that an interrupted run can be resumed:
+    python seed_tiles.py SoilMoisture --bbox -125 24 -66 50 --zoom 0 8 --time 2023-05-01 -p 8 --state seed.txt
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import multiprocessing
+
+from podpac import settings
+
+import tiles
+
+# Set in each worker process by `_init_worker`
+APP = None
+LAYER = None
+TOKEN = None
+
+
+def _init_worker(layer, token):
+    global APP, LAYER, TOKEN
+    import server  # builds the layers, once per worker process
+
+    APP = server.app.test_client()
+    LAYER = layer
+    TOKEN = token
+
+
+def _seed(job):
+    """Render one tile, returns `(job, status code, X-Cache header)`"""
+    z, x, y, time_ = job
+    query = {}
+    if time_:
+        query["TIME"] = time_
+    if TOKEN:
+        query["TOKEN"] = TOKEN
+    response = APP.get("/api/tiles/{}/{}/{}/{}.png".format(LAYER, z, x, y), query_string=query)
+    return job, response.status_code, response.headers.get("X-Cache")
+
+
+def job_id(job):
+    z, x, y, time_ = job
+    return "{}/{}/{}@{}".format(z, x, y, time_ or "")
+
+
+def make_jobs(bbox, zooms, times, done=()):
+    """Generates the tiles to seed, skipping the job ids in `done`"""
+    for z in zooms:
+        for x, y in tiles.tiles_in_bbox(bbox, z):
+            for time_ in times:
+                job = z, x, y, time_
+                if job_id(job) not in done:
+                    yield job
+
+
+def batches(jobs, size):
+    """Groups `jobs` in lists of (at most) `size` jobs. `Pool.imap_unordered` queues all the jobs of its iterable
+    right away, so the jobs are submitted batch by batch to keep the memory used constant."""
+    batch = []
+    for job in jobs:
+        batch.append(job)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Pre-render the XYZ tiles of a published layer into the GetMap cache")
+    parser.add_argument("layer", help="Name of the published layer")
+    parser.add_argument(
+        "--bbox", nargs=4, type=float, default=[-180, -85, 180, 85], metavar=("WEST", "SOUTH", "EAST", "NORTH"),
+        help="Extent to seed, in degrees (default: everything)"
+    )
+    parser.add_argument("--zoom", nargs=2, type=int, required=True, metavar=("MIN", "MAX"), help="Zoom levels to seed")
+    parser.add_argument("--time", action="append", default=None, help="TIME to seed (can be repeated)")
+    parser.add_argument("-p", "--processes", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument("--state", help="File recording the seeded tiles. Tiles listed in it are skipped (resume).")
+    parser.add_argument("--token", help="TOKEN passed on to the tile requests")
+    parser.add_argument("--batch-size", type=int, default=10000, help="Tiles submitted to the processes at a time")
+    parser.add_argument("--report-every", type=float, default=10.0, help="Seconds between progress reports")
+    parser.add_argument("--dry-run", action="store_true", help="Only print the number of tiles to seed")
+    args = parser.parse_args(argv)
+
+    zooms = range(args.zoom[0], args.zoom[1] + 1)
+    times = args.time or [None]
+    counts = {z: tiles.count_tiles(args.bbox, z) * len(times) for z in zooms}
+    total = sum(counts.values())
+    for z, count in counts.items():
+        print("zoom {:2d}: {} tiles".format(z, count))
+    print("total: {} tiles".format(total))
+    if args.dry_run:
+        return 0
+
+    settings.update(json.loads(os.environ.get("SETTINGS", "{}")))  # as in server.py
+    if not settings.get("GETMAP_CACHE", {}).get("disk_path"):
+        print("The GetMap disk cache is disabled (GETMAP_CACHE.disk_path), seeded tiles would not be shared")
+        return 1
+
+    done = set()
+    if args.state and os.path.exists(args.state):
+        with open(args.state) as file:
+            done = set(line.strip() for line in file)
+        print("resuming: {} tiles already seeded".format(len(done)))
+    jobs = make_jobs(args.bbox, zooms, times, done)
+
+    state = open(args.state, "a") if args.state else None
+    seeded = cached = errors = 0
+    start = last_report = time.time()
+    with multiprocessing.Pool(args.processes, _init_worker, (args.layer, args.token)) as pool:
+        for batch in batches(jobs, args.batch_size):
+            for job, status, x_cache in pool.imap_unordered(_seed, batch, chunksize=4):
+                if status in [200, 304]:
+                    seeded += 1
+                    cached += x_cache == "HIT"
+                    if state is not None:
+                        state.write(job_id(job) + "\n")
+                else:
+                    errors += 1
+                    print("tile {} failed with status {}".format(job_id(job), status))
+                now = time.time()
+                if now - last_report >= args.report_every:
+                    last_report = now
+                    if state is not None:
+                        state.flush()
+                    print("{}/{} tiles ({} already seeded, {} already cached, {} errors), {:.1f} tiles/s".format(
+                        len(done) + seeded + errors, total, len(done), cached, errors, (seeded + errors) / (now - start)))
+    if state is not None:
+        state.close()
+
+    elapsed = time.time() - start
+    print("seeded {} tiles ({} already cached, {} errors) in {:.1f} s, {:.1f} tiles/s".format(
+        seeded, cached, errors, elapsed, (seeded + errors) / elapsed if elapsed else 0))
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
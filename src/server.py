@@ -1,10 +1,16 @@
 import json
 import os
+import time
+import hashlib
+import threading
+import contextlib
 from datetime import datetime
+from urllib.parse import urlencode
 
 import matplotlib
-from flask import request, make_response, send_from_directory
+from flask import request, make_response, send_from_directory, send_file, g
 import requests
+from werkzeug.datastructures import ImmutableMultiDict
 
 from podpac import settings
 import podpac.datalib
@@ -13,7 +19,16 @@ from flask_cors import CORS
 from authentication import authorize, wrap_html_and_forward_auth_token
 from utils import _uppercase_for_dict_keys, _string_to_html, parse_url
 from publishing_api import publish_pipeline, query_pipeline, remove_pipeline
-from server_layers import Layers, home
+from server_layers import Layers, home, layer_set_fingerprint, document_layer
+from layer_store import make_layer_store
+from time_axis import compact_time_dimensions
+import tiles
+from admission import AdmissionControl, Overloaded
+from metrics import METRICS
+import profiling
+import eval_cache
+import image_encoding
+from caches import make_response_cache, make_request_key, DiskCache, DocumentCache, SingleFlight
 
 """
 Below are the remaining imports that should be 'cleaned' for open-source release.
@@ -37,6 +52,12 @@ def DEFAULT_COORDS():
 # Update settings from environmental variables on the image (this take precedence over the JSON file)
 settings.update(json.loads(os.environ.get("SETTINGS", "{}")))
 settings.allow_unrestricted_code_execution(True)
+# Makes the host-wide evaluation cache available as "shared" (e.g. in DEFAULT_CACHE), see EVAL_CACHE
+eval_cache.register()
+# Colormap + PNG fast path for GetMap images, podpac's matplotlib rendering remains the fallback
+IMAGE_ENCODING_SETTINGS = settings.get("IMAGE_ENCODING", {})
+if IMAGE_ENCODING_SETTINGS.get("fast_path", True):
+    image_encoding.install(IMAGE_ENCODING_SETTINGS.get("compress_level", 6))
 
 # Updating environmental variables so that Rasterio will properly access S3 files on govcloud
 AWS_SETTINGS = ["AWS_S3_ENDPOINT", "AWS_SECRET_ACCESS_KEY", "AWS_ACCESS_KEY_ID", "AWS_DEFAULT_REGION"]
@@ -49,55 +70,387 @@ print (os.environ)
 # SETTING UP LAYERS AND OGC ENDPOINTS #
 #######################################
 
-LAYERS = Layers(source=settings["PUBLISHED_PIPELINES"]["path"])
+LAYERS = Layers(
+    source=settings["PUBLISHED_PIPELINES"]["path"],
+    store=make_layer_store(
+        settings["PUBLISHED_PIPELINES"]["path"],
+        **settings["PUBLISHED_PIPELINES"].get("store_options", {})
+    ),
+    max_workers=settings["PUBLISHED_PIPELINES"].get("build_workers", 8),
+    build_timeout=settings["PUBLISHED_PIPELINES"].get("build_timeout", 60.0),
+    retry_interval=settings["PUBLISHED_PIPELINES"].get("retry_interval", 60.0),
+    coverage_chunks=settings.get("GETCOVERAGE_CHUNKS", {}),
+)
 print("="*80)
 print('STARTING LAYERS')
 print(LAYERS.ogc_layers)
+if LAYERS.failures:
+    print('FAILED LAYERS (retrying in the background)')
+    print(LAYERS.failures)
 print("="*80)
 
 ############################
 #    SETTING UP THE APP    #
 ############################
 
-OGC = ogc.core.OGC(
-    endpoint=APP_ROOT,
-    layers=list(LAYERS.ogc_layers),
-    service_group_title="SoilMAP RPP Layers"
+# Default snapping of the requested TIME to the layer's valid times ("exact", "nearest", "previous", "next"),
+# can be overwritten using the TIME_SNAP query parameter. By default, TIME is passed on unchanged.
+TIME_SNAP = settings.get("TIME_SNAP", None)
+
+# Rendered WMS GetMap responses, keyed on the arguments that affect the image
+GETMAP_CACHE = make_response_cache(**settings.get("GETMAP_CACHE", {}))
+GETMAP_CACHE_KEYS = [
+    "service", "request", "version", "params", "interpolation", "crs", "srs", "width", "height", "time", "styles",
+    "format", "transparent",
+]
+LAYERS.change_callbacks.append(lambda key, local: GETMAP_CACHE.invalidate(key, disk=local))
+
+# Encoded WCS GetCoverage responses, on local disk only (they can be large), streamed back to the client
+COVERAGE_CACHE_SETTINGS = settings.get("GETCOVERAGE_CACHE", {})
+COVERAGE_CACHE = None
+if COVERAGE_CACHE_SETTINGS.get("disk_path"):
+    COVERAGE_CACHE = DiskCache(
+        path=COVERAGE_CACHE_SETTINGS["disk_path"],
+        max_bytes=int(COVERAGE_CACHE_SETTINGS.get("disk_bytes", 1E10))
+    )
+    LAYERS.change_callbacks.append(lambda key, local: local and COVERAGE_CACHE.invalidate(key))
+COVERAGE_CACHE_KEYS = [
+    "service", "request", "version", "params", "interpolation", "crs", "response_crs", "bbox", "width", "height",
+    "resx", "resy", "time", "format",
+]
+
+# Renders in progress: identical concurrent GetMap/GetCoverage requests wait for the first one and share its response.
+# With a `lock_path`, the workers on a host also take turns (sharing the results through the disk caches).
+RENDERS = SingleFlight(**settings.get("COALESCE_RENDERS", {}))
+
+# Host-wide limits on concurrent renders (per request type and per layer), disabled unless configured
+ADMISSION = AdmissionControl(**settings["ADMISSION"]) if settings.get("ADMISSION") else None
+
+# Profiles of the requests with PROFILE=1 (see `start_profile`) are saved to PROFILING["path"], if set
+PROFILING_SETTINGS = settings.get("PROFILING", {})
+
+# Metrics, see `metrics_route`
+METRICS.path = settings.get("METRICS", {}).get("path")
+METRICS.flush_interval = settings.get("METRICS", {}).get("flush_interval", 5.0)
+METRICS_REQUEST_TYPES = [
+    "getcapabilities", "getmap", "getcoverage", "describecoverage", "getlegendgraphic", "getfeatureinfo",
+    "publish", "query", "remove",
+]
+REQUESTS = METRICS.counter("rpp_http_requests_total", "HTTP requests", ["route", "request", "status"])
+REQUEST_SECONDS = METRICS.histogram("rpp_http_request_duration_seconds", "HTTP request latency", ["route", "request"])
+RENDER_SECONDS = METRICS.histogram(
+    "rpp_render_seconds", "Evaluation and encoding time of the renders that missed the caches", ["request", "layer"]
+)
+OGC_REBUILD_SECONDS = METRICS.histogram(
+    "rpp_ogc_rebuild_seconds", "Time spent rebuilding the OGC object after the layer set changed"
 )
+
+@METRICS.collector
+def cache_metrics():
+    tiers = [
+        ("getmap_ram", GETMAP_CACHE.ram),
+        ("getmap_disk", GETMAP_CACHE.disk),
+        ("getcoverage_disk", COVERAGE_CACHE),
+        ("documents", DOCUMENT_CACHE),
+        ("eval_shared", eval_cache.current_cache()),
+    ]
+    items = []
+    for name, tier in tiers:
+        if tier is not None:
+            items.append(("rpp_cache_hits_total", "Cache hits", {"cache": name}, tier.hits))
+            items.append(("rpp_cache_misses_total", "Cache misses", {"cache": name}, tier.misses))
+    items.append(("rpp_renders_coalesced_total", "Requests that shared the render of an identical request", {},
+                  RENDERS.coalesced))
+    if ADMISSION is not None:
+        items.append(("rpp_admission_rejected_total", "Requests rejected by the admission control", {},
+                      ADMISSION.rejected))
+    return items
+
+@METRICS.gauge
+def host_metrics():
+    items = [
+        ("rpp_layers_published", "Published layers", {}, len(LAYERS._ogc_layers_cache)),
+        ("rpp_layers_failed", "Layers that failed to build", {}, len(LAYERS.failures)),
+    ]
+    for request_type, status in (ADMISSION.status() if ADMISSION is not None else {}).items():
+        items.append(("rpp_admission_active", "Renders in progress (host-wide)", {"request": request_type},
+                      status["active"]))
+        items.append(("rpp_admission_queued", "Requests waiting for a render slot (host-wide)",
+                      {"request": request_type}, status["queued"]))
+    return items
+
+# XYZ tiles (see `tile_route`)
+TILES_SETTINGS = settings.get("TILES", {})
+
+# GetCapabilities / DescribeCoverage documents, for the current layer-set fingerprint (max_entries 0 disables it)
+DOCUMENT_CACHE = DocumentCache(max_entries=int(settings.get("DOCUMENT_CACHE", {}).get("max_entries", 1000)))
+LAYERS.change_callbacks.append(lambda key, local: DOCUMENT_CACHE.clear())
+
+def make_ogc(layers):
+    return ogc.core.OGC(
+        endpoint=APP_ROOT,
+        layers=list(layers),
+        service_group_title="SoilMAP RPP Layers"
+    )
+
+OGC_VERSION = LAYERS.version
+OGC_LAYERS = list(LAYERS.ogc_layers)
+OGC = make_ogc(OGC_LAYERS)
+
 class FlaskServerDynamic(ogc.servers.FlaskServer):
+    def __init__(self, *args, **kwargs):
+        # Layer-set version and fingerprint each OGC object in self.ogcs was built from, and the time axes of its layers
+        self.ogc_versions = {}
+        self.ogc_fingerprints = {}
+        self.ogc_valid_times = {}
+        self.ogc_layer_map = {}
+        # OGC index --> (layer-set version, index in self.ogcs) of the OGC object rendering its capabilities documents
+        self.document_ogcs = {}
+        self._document_lock = threading.Lock()
+        super().__init__(*args, **kwargs)
+
+    def set_ogc(self, ogc_idx, layers, version, ogc=None):
+        """ Set the OGC object at `ogc_idx`, built from `layers` (version `version` of the layer set) """
+        self.ogcs[ogc_idx] = ogc if ogc is not None else make_ogc(layers)
+        self.ogc_versions[ogc_idx] = version
+        self.ogc_fingerprints[ogc_idx] = layer_set_fingerprint(layers)
+        self.ogc_valid_times[ogc_idx] = {l.identifier: getattr(l, "valid_times", None) for l in layers}
+        self.ogc_layer_map[ogc_idx] = {l.identifier: l for l in layers}
+
+    def document_ogc(self, ogc_idx):
+        """ Index in self.ogcs of the OGC object rendering the capabilities documents of the OGC object at `ogc_idx`. Its
+        layers have their regular time axes reduced to a single value (see `document_layer`). There is no route for it,
+        it is only rendered by `cached_document_render`. """
+        version = self.ogc_versions.get(ogc_idx)
+        with self._document_lock:
+            document_version, document_idx = self.document_ogcs.get(ogc_idx, (None, None))
+            if document_idx is None:
+                document_idx = len(self.ogcs)
+                self.ogcs.append(None)
+            if document_version != version or self.ogcs[document_idx] is None:
+                layers = [document_layer(l) for l in self.ogc_layer_map[ogc_idx].values()]
+                self.ogcs[document_idx] = make_ogc(layers)
+                self.document_ogcs[ogc_idx] = (version, document_idx)
+        return document_idx
+
+    def update_ogc(self, ogc_idx):
+        """ Rebuild the OGC object at `ogc_idx` if the layer set changed (which also builds the new OGC layers, so
+        `LAYERS.definition_hash` is up to date afterwards) """
+        # Layers can be published/changed/removed at any time, so the OGC object has to follow the layer store.
+        # Rebuilding it on every request is expensive, so only do so when the layer-set version changed. Unchanged
+        # layers are re-used from the LAYERS cache, so only the affected OGCLayer entries are actually swapped in.
+        version = LAYERS.version
+        if self.ogc_versions.get(ogc_idx) != version:
+            print("Layer set changed (version {} --> {}), updating OGC layers".format(self.ogc_versions.get(ogc_idx), version))
+            with OGC_REBUILD_SECONDS.time(), profiling.span("ogc_rebuild"):
+                self.set_ogc(ogc_idx, list(LAYERS.ogc_layers), version)
+
     @authorize
     def ogc_render(self, ogc_idx):
-        # Optimization, if this is an WMS  or WCS request, just make sure the requested layer is updated
-        #  convert to lower-case.
-        args = {k.lower(): str(v) for (k, v) in request.args.items()}
-        if False: #(args.get('service', '').lower() == 'wcs' and args.get('request', '').lower() == "getcoverage") or \
-            # (args.get('service', '').lower() == 'wms' and args.get('request', '').lower() == 'getmap'):
-            identifier = args.get('layers', args.get('coverage'))
-            print("Just updating one layer for WMS/WCS", args)
-            sf = LAYERS.skip_failed
-            LAYERS.skip_failed = True
-            self.ogcs[ogc_idx] = ogc.core.OGC(
-                endpoint=APP_ROOT,
-                layers=list(LAYERS.ogc_layers),
-                service_group_title="SoilMAP RPP Layers"
-            )
-            LAYERS.skip_failed = sf
-
-        else:
-            print("Updating ALL layers", args)
-            # Need to overwrite ogc_render to dynamically add layers -- since these can change
-            LAYERS.skip_failed = False
-            self.ogcs[ogc_idx] = ogc.core.OGC(
-                endpoint=APP_ROOT,
-                layers=list(LAYERS.ogc_layers),
-                service_group_title="SoilMAP RPP Layers"
-            )
+        self.update_ogc(ogc_idx)
 
         # also need to overwrite ogc_render to allow the TOKEN arg
         if len(request.args) == 1 and list(request.args.keys())[0].upper() == "TOKEN":
             return self.home_func(self.ogcs[ogc_idx])
+
+        args = {k.lower(): v for (k, v) in request.args.items()}
+        if args.get("request", "").lower() in ["getcapabilities", "describecoverage"]:
+            return self.cached_document_render(ogc_idx, args)
+
+        mode = args.get("time_snap", TIME_SNAP)
+        if args.get("time") and mode and args.get("request", "").lower() in ["getmap", "getcoverage"]:
+            error = self.snap_time(ogc_idx, args, mode, args.get("layers", args.get("coverage", "")))
+            if error is not None:
+                return error
+        try:
+            if args.get("service", "").lower() == "wms" and args.get("request", "").lower() == "getmap":
+                return self.cached_render(ogc_idx, GETMAP_CACHE, GETMAP_CACHE_KEYS, args, args.get("layers", ""))
+            if args.get("service", "").lower() == "wcs" and args.get("request", "").lower() == "getcoverage":
+                if COVERAGE_CACHE is not None:
+                    return self.cached_file_render(
+                        ogc_idx, COVERAGE_CACHE, COVERAGE_CACHE_KEYS, args, args.get("coverage", "")
+                    )
+                return self.admitted_render(ogc_idx, "getcoverage", args.get("coverage", ""))
+        except Overloaded as e:
+            response = make_response(str(e), 503)
+            response.headers.set("Retry-After", str(e.retry_after))
+            return response
         return super().ogc_render(ogc_idx)
 
+    def admitted_render(self, ogc_idx, request_type, layer):
+        """ Render the request once ADMISSION allows it (raises `Overloaded` otherwise) """
+        if LAYERS.definition_hash(layer) is None:
+            layer = "other"  # unknown layers or combinations of layers, bounds the number of metrics series
+        with ADMISSION.admit(request_type, layer) if ADMISSION is not None else contextlib.nullcontext():
+            with RENDER_SECONDS.time(request=request_type, layer=layer), profiling.span("render"):
+                return self.make_response(super().ogc_render(ogc_idx))
+
+    def snap_time(self, ogc_idx, args, mode, layer):
+        """
+        Replace the requested TIME by the matching valid times of `layer` (snapped according to `mode`, see
+        `TimeAxis.index`), in both `args` and the request. Returns an error response if a time cannot be matched.
+        """
+        layer = self.ogc_layer_map.get(ogc_idx, {}).get(layer)
+        if layer is None or not hasattr(layer, "resolve_time"):
+            return None
+        try:
+            times = layer.resolve_time(args["time"], mode)
+        except ValueError as e:
+            return make_response(str(e), 400)
+        if times is None:
+            return None
+        if not times:
+            return make_response("TIME '{}' does not contain any valid time".format(args["time"]), 400)
+        args["time"] = ",".join(times)
+        request_args = request.args.copy()
+        for key in [k for k in request_args if k.lower() == "time"]:
+            request_args[key] = args["time"]
+        request.args = ImmutableMultiDict(request_args)
+        return None
+
+    def cached_render(self, ogc_idx, cache, keys, args, layers):
+        """ Serve the response from `cache` if possible, otherwise render it and cache successful image responses """
+        layers = layers.split(",")
+        hashes = [LAYERS.definition_hash(layer) for layer in layers]
+        if None in hashes:
+            # Unknown or failed layer, let the OGC server respond
+            return super().ogc_render(ogc_idx)
+
+        group = ",".join(layers)
+        key = cache.make_key(args, layers, hashes, keys)
+        entry = cache.get(key, group)
+        x_cache = "HIT"
+        if entry is None:
+            # Identical concurrent requests wait for the first one and share its response
+            (entry, x_cache), shared = RENDERS.do(key, lambda: self.render_and_cache(ogc_idx, cache, key, group))
+            if shared:
+                x_cache = "COALESCED"
+
+        if isinstance(entry, tuple):
+            response = make_response(entry[0])
+            response.mimetype = entry[1]
+        else:  # response that is not cached (e.g. an error)
+            response = self.copy_response(entry) if shared else entry
+        response.headers.set("X-Cache", x_cache)
+        return response
+
+    def render_and_cache(self, ogc_idx, cache, key, group):
+        """ Render the request and cache successful image responses. Returns `((body, mimetype), x_cache)`, or the
+        response itself for responses that are not cached. """
+        entry = cache.get(key, group)  # may have been rendered by another worker in the meantime
+        if entry is not None:
+            return entry, "HIT"
+        response = self.admitted_render(ogc_idx, "getmap", group)
+        response.direct_passthrough = False
+        if response.status_code == 200 and response.mimetype.startswith("image/"):
+            entry = response.get_data(), response.mimetype
+            cache.put(key, group, *entry)
+            return entry, "MISS"
+        response.get_data()  # buffer, the response may be shared by coalesced requests
+        return response, "MISS"
+
+    @staticmethod
+    def copy_response(response):
+        return make_response(response.get_data(), response.status_code, list(response.headers.items()))
+
+    def cached_document_render(self, ogc_idx, args):
+        """
+        Serve capabilities documents from the DOCUMENT_CACHE, compressed according to the client's Accept-Encoding,
+        with ETag and Last-Modified headers so clients can re-validate them (304). Regular time dimensions are listed
+        as ISO 8601 intervals (start/stop/step) instead of item by item: the document is rendered with a single value
+        per regular time axis (see `document_ogc`), which is then replaced by the interval.
+        """
+        key = json.dumps([request.host_url, sorted((k, v) for k, v in args.items() if k != "token")])
+        fingerprint = self.ogc_fingerprints.get(ogc_idx)
+        entry = DOCUMENT_CACHE.get(fingerprint, key)
+        x_cache = "HIT"
+        if entry is None:
+            x_cache = "MISS"
+            response = self.make_response(super().ogc_render(self.document_ogc(ogc_idx)))
+            if response.status_code != 200:
+                return response
+            response.direct_passthrough = False
+            body = compact_time_dimensions(response.get_data(), self.ogc_valid_times.get(ogc_idx, {}))
+            entry = DOCUMENT_CACHE.put(fingerprint, key, body, response.mimetype)
+
+        encodings = [e for e in ["br", "gzip"] if entry[e] is not None]
+        encoding = request.accept_encodings.best_match(encodings + ["identity"], default="identity")
+        response = make_response(entry[encoding])
+        response.mimetype = entry["mimetype"]
+        if encoding != "identity":
+            response.headers.set("Content-Encoding", encoding)
+        response.vary.add("Accept-Encoding")
+        # Each encoding is a different representation, so it needs its own (strong) ETag
+        response.set_etag(entry["etag"] if encoding == "identity" else "{}-{}".format(entry["etag"], encoding))
+        response.last_modified = entry["last_modified"]
+        response.headers.set("X-Cache", x_cache)
+        return response.make_conditional(request)
+
+    def cached_file_render(self, ogc_idx, cache, keys, args, layer):
+        """
+        Serve the response from the disk `cache` if possible, otherwise render and cache it. The cached file is streamed
+        back to the client, with the cache key as ETag (it includes the definition hash, so it identifies the content).
+        """
+        definition_hash = LAYERS.definition_hash(layer)
+        if definition_hash is None:
+            return super().ogc_render(ogc_idx)
+
+        # The BBOX is part of the keys, it should not be rounded for coverages
+        key = make_request_key(args, [layer], [definition_hash], keys, bbox_tolerance=0)
+        if key in request.if_none_match:
+            response = make_response("", 304)
+            response.set_etag(key)
+            return response
+
+        # The cached file is opened right away: other workers can evict it at any time, but not from an open file
+        entry = cache.open_entry(key, layer)
+        x_cache = "HIT"
+        if entry is None:
+            (entry, x_cache), shared = RENDERS.do(key, lambda: self.render_to_file(ogc_idx, cache, key, layer))
+            if shared:
+                x_cache = "COALESCED"
+            if not isinstance(entry, tuple):  # response that is not cached
+                return self.copy_response(entry) if shared else entry
+            path, meta = entry
+            try:
+                entry = open(path, "rb"), meta
+            except FileNotFoundError:  # evicted by another worker in the meantime, render it again without the cache
+                return self.admitted_render(ogc_idx, "getcoverage", layer)
+
+        file, meta = entry
+        size = os.fstat(file.fileno()).st_size
+        response = send_file(file, mimetype=meta["mimetype"], etag=key, conditional=False)
+        response.content_length = size
+        response = response.make_conditional(request, accept_ranges=True, complete_length=size)
+        if meta.get("content_disposition"):
+            response.headers.set("Content-Disposition", meta["content_disposition"])
+        response.headers.set("X-Cache", x_cache)
+        return response
+
+    def render_to_file(self, ogc_idx, cache, key, layer):
+        """ Render the request into the disk `cache`. Returns `((path, meta), x_cache)`, or the (buffered) response
+        itself for responses that are not cached. The OGC library encodes the whole coverage in memory, it is then
+        written to the cache (without a second copy in memory), and served from there. """
+        entry = cache.get_path(key, layer)  # may have been rendered by another worker in the meantime
+        if entry is not None:
+            return entry, "HIT"
+        response = self.admitted_render(ogc_idx, "getcoverage", layer)
+        if not self.is_coverage(response):
+            response.direct_passthrough = False
+            response.get_data()
+            return response, "MISS"
+        meta = {"mimetype": response.mimetype, "content_disposition": response.headers.get("Content-Disposition")}
+        try:
+            path = cache.put_stream(key, layer, response.iter_encoded(), **meta)
+        finally:
+            response.close()
+        return (path, meta), "MISS"
+
+    @staticmethod
+    def is_coverage(response):
+        """ False for errors and exception reports """
+        return response.status_code == 200 and "xml" not in response.mimetype and "html" not in response.mimetype
+
     def add_url_rule(self,
             rule,
             endpoint=None,
@@ -115,8 +468,59 @@ app = FlaskServerDynamic(
     __name__,
     ogcs=[OGC, ],
     home_func=lambda ogc: wrap_html_and_forward_auth_token(home(ogc)))#, static_url_path='ui')
+app.set_ogc(0, OGC_LAYERS, OGC_VERSION, OGC)
 CORS(app)
 
+@app.before_request
+def start_request_timer():
+    g.request_start = time.time()
+
+def profile_requested():
+    """ PROFILE=1 query parameter (or X-Profile: 1 header), with a publishing KEY (or X-Profile-Key header) """
+    args = {k.upper(): v for k, v in request.args.items()}
+    if args.get("PROFILE", request.headers.get("X-Profile", "")).lower() not in ["1", "true"]:
+        return False
+    key = request.headers.get("X-Profile-Key", args.get("KEY"))
+    return key is not None and key in settings.get("PUBLISHED_PIPELINES", {}).get("secret_key", [])
+
+@app.before_request
+def start_profile():
+    if profile_requested():
+        g.profile = profiling.Profile().__enter__()
+
+@app.after_request
+def finish_profile(response):
+    profile = g.pop("profile", None)
+    if profile is None:
+        return response
+    profile.__exit__()
+    name = "{}-{}-{}".format(time.strftime("%Y%m%dT%H%M%S"), os.getpid(), id(profile))
+    response.headers.set("Server-Timing", profile.server_timing())
+    response.headers.set("X-Profile-Id", name)
+    if PROFILING_SETTINGS.get("path"):
+        profile.dump(PROFILING_SETTINGS["path"], name)
+    return response
+
+@app.teardown_request
+def stop_profile(exception=None):
+    # The request failed before `finish_profile`
+    profile = g.pop("profile", None)
+    if profile is not None:
+        profile.__exit__()
+
+@app.after_request
+def record_request_metrics(response):
+    route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    args = {k.lower(): v.lower() for k, v in request.args.items() if k.lower() in ["request", "service"]}
+    # OGC REQUEST, or publishing API SERVICE. Only known values are used as labels, to bound the number of series.
+    request_type = args.get("request", args.get("service", ""))
+    if request_type not in METRICS_REQUEST_TYPES:
+        request_type = "other" if request_type else ""
+    REQUESTS.inc(route=route, request=request_type, status=response.status_code)
+    if "request_start" in g:
+        REQUEST_SECONDS.observe(time.time() - g.request_start, route=route, request=request_type)
+    return response
+
 ##########################
 # AWS Lambda Integration #
 ##########################
@@ -142,6 +546,95 @@ def root():
     <p>This server is built using the open source <a href="https://podpac.org">PODPAC library</a>. </p>
     """)
 
+@app.route(APP_ROOT + "ready")
+def ready_route():
+    """
+    Readiness of the published layers: returns 503 while layers are still being built. Layers that failed to build
+    are listed (and retried in the background), but do not prevent the server from being ready.
+    """
+    response = make_response(json.dumps({
+        "ready": LAYERS.ready,
+        "layers": len(LAYERS._ogc_layers_cache),
+        "failures": LAYERS.failures,
+    }))
+    response.status_code = 200 if LAYERS.ready else 503
+    response.mimetype = "application/json"
+    return response
+
+@app.route(APP_ROOT + "metrics")
+def metrics_route():
+    """ Prometheus metrics, summed over all the workers of the host (if METRICS.path is set) """
+    response = make_response(METRICS.render())
+    response.mimetype = "text/plain"
+    response.headers.set("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+    return response
+
+@app.route(APP_ROOT + "admission")
+def admission_route():
+    """ Renders in progress and queued requests (host-wide), per request type, to tune the ADMISSION limits """
+    response = make_response(json.dumps({
+        "enabled": ADMISSION is not None,
+        "status": ADMISSION.status() if ADMISSION is not None else {},
+        "rejected": ADMISSION.rejected if ADMISSION is not None else 0,
+    }))
+    response.mimetype = "application/json"
+    return response
+
+@app.route(APP_ROOT + "tiles/<layer>/<int:z>/<int:x>/<int:y>.png")
+@authorize
+def tile_route(layer, z, x, y):
+    """
+    XYZ tiles (WebMercatorQuad tile matrix set) of the published layers. Tiles are rendered as WMS GetMap requests, so
+    they share the GetMap cache, and are served with Cache-Control headers and an ETag that includes the layer
+    definition hash. Other query parameters (e.g. TIME, STYLES, PARAMS, TOKEN) are passed on to the GetMap request.
+
+    Tile URLs with the current definition hash as `v` parameter (as listed in the TileJSON) change when the layer is
+    republished, so these tiles can be cached for `max_age` seconds. Other tiles are cached for `revalidate_max_age`
+    seconds only, and must be re-validated after that.
+    """
+    app.update_ogc(0)  # layers published (or republished) since the last OGC request
+    definition_hash = LAYERS.definition_hash(layer)
+    if not tiles.is_valid_tile(z, x, y, TILES_SETTINGS.get("max_zoom", 24)) or definition_hash is None:
+        return make_response("Unknown tile {}/{}/{}/{}".format(layer, z, x, y), 404)
+    versioned = request.args.get("v") == definition_hash
+    extra = {k: v for k, v in request.args.items() if k != "v"}
+    args = tiles.getmap_args(layer, z, x, y, TILES_SETTINGS.get("tile_size", 256), extra)
+    request.args = ImmutableMultiDict(args)
+    response = app.make_response(app.ogc_render(0))
+    if response.status_code == 200 and response.mimetype == "image/png":
+        response.cache_control.public = True
+        if versioned:
+            response.cache_control.max_age = int(TILES_SETTINGS.get("max_age", 86400))
+        else:
+            response.cache_control.max_age = int(TILES_SETTINGS.get("revalidate_max_age", 60))
+            response.cache_control.must_revalidate = True
+        response.direct_passthrough = False
+        response.set_etag("{}-{}".format(definition_hash, hashlib.md5(response.get_data()).hexdigest()))
+        response = response.make_conditional(request)
+    return response
+
+@app.route(APP_ROOT + "tiles/<layer>.json")
+@authorize
+def tilejson_route(layer):
+    """ TileJSON description of the XYZ tiles of a layer, for web map clients. The tile URLs include the definition
+    hash of the layer (`v`), so they change when the layer is republished. """
+    app.update_ogc(0)
+    definition_hash = LAYERS.definition_hash(layer)
+    if definition_hash is None:
+        return make_response("Unknown layer {}".format(layer), 404)
+    query = [(k, v) for k, v in request.args.items(multi=True) if k != "v"] + [("v", definition_hash)]
+    response = make_response(json.dumps({
+        "tilejson": "2.2.0",
+        "name": layer,
+        "scheme": "xyz",
+        "tiles": [request.host_url.rstrip("/") + APP_ROOT + "tiles/" + layer + "/{z}/{x}/{y}.png?" + urlencode(query)],
+        "minzoom": 0,
+        "maxzoom": TILES_SETTINGS.get("max_zoom", 24),
+        "bounds": [-180, -tiles.MAX_LATITUDE, 180, tiles.MAX_LATITUDE],
+    }))
+    response.mimetype = "application/json"
+    return response
+
 @app.route(APP_ROOT+"publish/UI_spec")
 @authorize
 def publish_UI_route():
@@ -243,11 +736,14 @@ def publish_pipeline_route():
     service = pipeline["url"].get("SERVICE", [""])[0].upper()
 
     if service == "PUBLISH":
-        response = publish_pipeline(pipeline["url"], LAYERS)
+        with profiling.span("publish"):
+            response = publish_pipeline(pipeline["url"], LAYERS)
     elif service == "QUERY":
-        response = query_pipeline(pipeline["url"], LAYERS)
+        with profiling.span("query"):
+            response = query_pipeline(pipeline["url"], LAYERS)
     elif service == "REMOVE":
-        response = remove_pipeline(pipeline["url"], LAYERS)
+        with profiling.span("remove"):
+            response = remove_pipeline(pipeline["url"], LAYERS)
     else:
         response = "`{}` is an unrecognized service for this endpoint. ".format(
                 pipeline["url"].get("SERVICE", "<Unspecified>")
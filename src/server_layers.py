@@ -1,17 +1,33 @@
 import os
+import copy
+import threading
+import time
+import concurrent.futures
 import json
+import hashlib
 from collections import OrderedDict
 from typing import OrderedDict
 import traitlets as tl
-import datetime
 import numpy as np
 
 import ogc
 import podpac
 from ogc.podpac import Layer as OGCLayer0
-from podpac.core.authentication import S3Mixin
 from podpac import Node
 
+from layer_store import LayerStore, make_layer_store
+from time_axis import TimeAxis
+from chunked_eval import chunk_large_request
+from metrics import METRICS
+import profiling
+
+STORE_READ_SECONDS = METRICS.histogram(
+    "rpp_layer_store_read_seconds", "Time spent reading the layer store", ["operation"]
+)
+LAYER_BUILD_SECONDS = METRICS.histogram(
+    "rpp_layer_build_seconds", "Time spent building OGC layers (the count is the number of builds)", ["status"]
+)
+
 def home(ogc):
     """
     """
@@ -49,153 +65,410 @@ def _update_key(key:str, source:dict, dest:dict):
     return dest
 
 class OGCLayer(OGCLayer0):
-    valid_times = tl.List(trait=tl.Instance(datetime.date), default_value=tl.Undefined, allow_none=True)
+    """
+    OGC layer for a published pipeline. The capabilities only need the identifier, title, abstract, grid coordinates and
+    valid times, so the podpac node is only built from its `definition` when it is first needed (e.g. by `get_node`).
+    """
+    valid_times = tl.Instance(TimeAxis, default_value=None, allow_none=True)
+    definition = tl.Dict(allow_none=True, default_value=None)
+
+    definition_hash = tl.Unicode()
+    node_cache_size = tl.Int(16)
+    _node_cache = tl.Dict()
+    # GetCoverage requests larger than max_pixels are evaluated in chunks, see `chunked_eval.chunk_large_request`
+    coverage_chunks = tl.Dict()
+
+    @tl.default("node")
+    def _default_node(self):
+        return Node.from_json(json.dumps(self.definition))
+
+    @tl.default("definition_hash")
+    def _default_definition_hash(self):
+        definition = self.definition if self.definition is not None else self.node.definition
+        return hashlib.sha1(json.dumps(definition, sort_keys=True, cls=podpac.core.utils.JSONEncoder).encode("utf8")).hexdigest()
+
+    def resolve_time(self, times, mode="nearest"):
+        """
+        Resolve a TIME request parameter against the layer's valid times (see `TimeAxis.resolve`).
+        Returns a list of ISO 8601 strings, or None if the layer has no time dimension.
+        """
+        if self.valid_times is None:
+            return None
+        return np.datetime_as_string(self.valid_times.resolve(times, mode)).tolist()
+
     def get_node(self, args):
-        definition = self.node.definition
-        # print ("Pre DEF", definition, args.get("PARAMS"))
-        params = json.loads(args.get("PARAMS", "{}"))
+        with profiling.span("get_node"):
+            node = self._get_node(args)
+        if self.coverage_chunks and args.get("REQUEST", "").lower() == "getcoverage":
+            try:
+                pixels = int(args["WIDTH"]) * int(args["HEIGHT"])
+            except (KeyError, ValueError):
+                return node
+            node = chunk_large_request(node, pixels, **self.coverage_chunks)
+        return node
+
+    def _get_node(self, args):
+        params = json.loads(args.get("PARAMS") or "{}")
         if "INTERPOLATION" in args:
             attrs = params.get('attrs', {})
             attrs['interpolation'] = args["INTERPOLATION"]
             params['attrs'] = attrs
+        if not params:
+            return self.node
 
+        if self.definition is not None:
+            definition = copy.deepcopy(self.definition)
+        else:
+            definition = self.node.definition
         base = [k for k in definition.keys() if k != "podpac_version"][-1]
         for key in params:
             definition[base] = _update_key(key, params, definition[base])
-        # print ("Post DEF", definition)
-        node = Node.from_definition(definition)
-        print(node.json_pretty)
+
+        # Re-use the nodes of recent requests with the same overrides, including their podpac caches
+        key = hashlib.sha1(json.dumps(definition, sort_keys=True).encode("utf8")).hexdigest()
+        node = self._node_cache.pop(key, None)
+        if node is None:
+            node = Node.from_definition(definition)
+        self._node_cache[key] = node  # (re-)insert as most recently used
+        while len(self._node_cache) > self.node_cache_size:
+            self._node_cache.pop(next(iter(self._node_cache)), None)
         return node
 
 class Layers(tl.HasTraits):
     source = tl.Unicode()
-    s3 = tl.Any()
+    store = tl.Instance(LayerStore)
     default_times = tl.Any()
     default_grid_coordinates = tl.Instance(ogc.GridCoordinates)
     _ogc_layers_cache = tl.Dict()
     convert_requests_to_default_crs = tl.Bool(True)
     skip_failed = tl.Bool(False)
     persistent_layers = tl.List()
+    _version = tl.Int(0)
+    _layers_cache = tl.Any(default_value=None, allow_none=True)
+    _layers_stamp = tl.Any(default_value=None, allow_none=True)
+    _store_version = tl.Int(default_value=None, allow_none=True)
+    change_callbacks = tl.List()
+    max_workers = tl.Int(8)
+    build_timeout = tl.Float(60.0)
+    retry_interval = tl.Float(60.0)
+    failures = tl.Dict()
+    _pending = tl.Dict()
+    _executor = tl.Any(default_value=None, allow_none=True)
+    _executor_pid = tl.Int(default_value=None, allow_none=True)
+    _build_lock = tl.Instance(type(threading.RLock()), args=())
+    coverage_chunks = tl.Dict()
 
-    @tl.default("s3")
-    def _default_s3(self):
-        return (
-            S3Mixin().s3
-        )  # This will automatically pull credentials from aws config OR podpac settings
+    @tl.default("store")
+    def _default_store(self):
+        return make_layer_store(self.source)
 
     @property
     def _layers(self):
-        """ Need to read every time in case the file changes """
+        """
+        The layer store can be changed at any time (e.g. by another worker), but only re-read it when the backing store
+        actually changed, as reported by `LayerStore.stamp`. When the store logs its changes, only the changed layers
+        are updated, and exactly those entries are dropped from the OGC layers cache.
+        """
         try:
-            if self.source.startswith("s3://"):
-                data = self.s3.open(self.source, "r").read()
+            stamp = self.store.stamp()
+        except Exception as e:
+            stamp = None
+        if self._layers_cache is not None and stamp is not None and stamp == self._layers_stamp:
+            # Callers modify the returned dictionary, so never hand out the cached instance
+            return OrderedDict(self._layers_cache)
+
+        # The build threads update the OGC layers cache and the version under the same lock
+        notify = []
+        with self._build_lock:
+            changes = None
+            if self._layers_cache is not None:
+                with STORE_READ_SECONDS.time(operation="changes"):
+                    changes = self.store.changes(self._store_version)
+            if changes is None:
+                with STORE_READ_SECONDS.time(operation="load"):
+                    store_version = self.store.version()
+                    layers = self.store.load()
+                if self._layers_cache is None:
+                    self._version += 1
+                else:
+                    old = self._layers_cache
+                    changed = [key for key in set(old) | set(layers) if old.get(key) != layers.get(key)]
+                    if changed:
+                        self._version += 1
+                    notify = changed
             else:
-                data = open(self.source, "r").read()
-            return json.loads(data, object_pairs_hook=OrderedDict)
-        except:
-            if not self.source.startswith("s3://") and not os.path.exists(self.source):
-                open(self.source, "w").write(json.dumps({}))
-            return {}
+                store_version, items = changes
+                layers = OrderedDict(self._layers_cache)
+                for key, item in items.items():
+                    if item is None:
+                        layers.pop(key, None)
+                    else:
+                        layers[key] = item
+                    self._ogc_layers_cache.pop(key, None)
+                if items:
+                    self._version += 1
+                notify = list(items)
+            self._layers_cache = layers
+            self._layers_stamp = stamp
+            self._store_version = store_version
+        self._notify(notify)
+        return OrderedDict(layers)
+
+    @property
+    def version(self):
+        """
+        Monotonically increasing counter identifying the current set of published layers.
+        It only changes when a layer is published, changed, or removed, so consumers (e.g. the OGC
+        object used by the server) can be reused for as long as the version stays the same.
+        """
+        self._layers
+        return self._version
 
     def get(self, key, default=None):
         return self._layers.get(key, default)
 
+    def query(self, author_key):
+        """ Returns all the layers published using `author_key` """
+        return self.store.query(author_key)
+
     def set(self, key, item, clear_cache=True):
-        layers = self._layers
-        layers[key] = item
-        self.update(layers)
-        if clear_cache and key in self._ogc_layers_cache:
-            del self._ogc_layers_cache[key]
+        self.store.set(key, item)
+        self._layers_stamp = None
+        if clear_cache:
+            with self._build_lock:
+                self._ogc_layers_cache.pop(key, None)
+        self._notify([key], local=True)
 
     def remove(self, key):
-        layers = self._layers
-        del layers[key]
-        self.update(layers)
+        self.store.remove(key)
+        self._layers_stamp = None
+        self._notify([key], local=True)
 
     def update(self, layers):
-        data = json.dumps(layers)
-        if self.source.startswith("s3://"):
-            with self.s3.open(self.source, "w") as file:
-                file.write(data)
-        else:
-            with open(self.source, "w") as file:
-                file.write(data)
+        keys = set(self._layers) | set(layers)
+        self.store.update(layers)
+        self._layers_stamp = None
+        self._notify(keys, local=True)
+
+    def _notify(self, keys, local=False):
+        """
+        Calls the `change_callbacks` for each changed layer, as `callback(key, local)`, where `local` is True if the
+        change was made by this process (otherwise it was detected in the layer store).
+        """
+        for key in keys:
+            for callback in self.change_callbacks:
+                try:
+                    callback(key, local)
+                except Exception as e:
+                    print("Layer change callback failed for `{}`:".format(key), e)
+
+    def definition_hash(self, key):
+        """ Hash of the definition of OGC layer `key`, or None if the layer is not available """
+        entry = self._ogc_layers_cache.get(key)
+        if entry is None:
+            return None
+        return entry["node"].definition_hash
 
     @property
     def ogc_layers(self):
         """
         Returns the OGC Layers which are created as part of the OGC package.
         This structure is needed for WMS/WCS requests
+
+        Missing layers are built concurrently, waiting at most `build_timeout` seconds. Layers that are still being
+        built are added once they are ready, and layers that failed are retried in the background every
+        `retry_interval` seconds. In both cases, the layer-set `version` is bumped when the layer becomes available.
         """
-        # Remove any part of the cache that's no longer needed
-        # i.e. when a layer was removed.
-        kwargs = {}
-        ogc_layers = []
-        # Remove any part of the cache that's no longer needed
-        # i.e. when a layer was removed.
+        with profiling.span("ogc_layers"):
+            return self._make_ogc_layers()
+
+    def _make_ogc_layers(self):
         layers = self._layers
-        keys = list(self._ogc_layers_cache.keys())
-        for key in keys:
-            if (key not in layers) or (self._ogc_layers_cache[key]['definition'] != layers[key]['definition']):
-                del self._ogc_layers_cache[key]
+        with self._build_lock:
+            # Remove any part of the cache that's no longer needed
+            # i.e. when a layer was removed.
+            for key in list(self._ogc_layers_cache.keys()):
+                if (key not in layers) or (self._ogc_layers_cache[key]['definition'] != layers[key]['definition']):
+                    del self._ogc_layers_cache[key]
+            # Failures are only kept for the definition that failed: a layer republished with a new definition is
+            # built again right away (its pending build, if any, is replaced by `_build`)
+            for key in list(self.failures.keys()):
+                if key not in layers or self.failures[key]["definition"] != layers[key]["definition"]:
+                    del self.failures[key]
+
+            futures = []
+            if not self.skip_failed:
+                for layer in layers:
+                    if layer not in self._ogc_layers_cache and layer not in self.failures:
+                        futures.append(self._build(layer, layers[layer]))
+        concurrent.futures.wait([f for f in futures if f is not None], timeout=self.build_timeout)
 
         # Make the OGC layers
-        for layer in layers:
-            l = None
-            if layer in self._ogc_layers_cache:
-                l = self._ogc_layers_cache[layer]['node']
-            elif not self.skip_failed:
-                try:
-                    l = self.make_ogc_layer(layer, layers[layer])
-                except Exception as e:
-                    print ("Exception creating ogc layer:", type(e), e)
-                    continue
-                self._ogc_layers_cache[layer] = {"definition": layers[layer]["definition"], "node": l}
-            if l is not None:
-                ogc_layers.append(l)
+        ogc_layers = []
+        with self._build_lock:
+            for layer in layers:
+                if layer in self._ogc_layers_cache:
+                    ogc_layers.append(self._ogc_layers_cache[layer]['node'])
+                elif layer in self._pending and layer not in self.failures:
+                    self.failures[layer] = {
+                        "error": "Timed out after {} seconds".format(self.build_timeout),
+                        "attempts": 0,
+                        "definition": layers[layer]["definition"],
+                    }
 
         return self.persistent_layers + ogc_layers
 
-    def make_ogc_layer(self, name, layer, abstract=""):
-        node = Node.from_json(json.dumps(layer["definition"]))
-        coords = node.find_coordinates()
-        kwargs = {}
-        if len(coords) == 1:
-            try:
-                coords = coords[0]
-                if "time" in coords.udims:
-                    dt = coords['time'].coordinates.astype(object).tolist()
-                    kwargs["valid_times"] = dt
-                    # Need to drop time, otherwise podpac won't give us a geotransform.
-                    coords = coords.udrop('time')
-
-                gt = coords.geotransform
-                gc = ogc.GridCoordinates(
-                    geotransform=gt,
-                    x_size=coords["lon"].size,
-                    y_size=coords["lat"].size
-                )
-                kwargs["grid_coordinates"] = gc
+    @property
+    def ready(self):
+        """ True when no layers are being built anymore (but some layers may have failed, see `failures`) """
+        return not self._pending
+
+    def _build(self, name, layer):
+        """ Build OGC layer `name` in the thread pool, unless it is already being built. Call with _build_lock held """
+        if name in self._pending and self._pending[name]["definition"] == layer["definition"]:
+            return None
+        if self._executor is None or self._executor_pid != os.getpid():  # The pool does not survive a fork
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers)
+            self._executor_pid = os.getpid()
+        future = self._executor.submit(self._timed_make_ogc_layer, name, layer)
+        self._pending[name] = {"definition": layer["definition"], "future": future}
+        future.add_done_callback(lambda f: self._built(name, layer, f))
+        return future
+
+    def _timed_make_ogc_layer(self, name, layer):
+        start = time.time()
+        status = "failed"
+        try:
+            ogc_layer = self.make_ogc_layer(name, layer)
+            status = "ok"
+            return ogc_layer
+        finally:
+            LAYER_BUILD_SECONDS.observe(time.time() - start, status=status)
 
+    def _built(self, name, layer, future):
+        with self._build_lock:
+            pending = self._pending.get(name)
+            if pending is None or pending["future"] is not future:
+                return
+            del self._pending[name]
+            current = (self._layers_cache or {}).get(name)
+            if current is None or current["definition"] != layer["definition"]:
+                return  # Changed or removed in the meantime
+            try:
+                l = future.result()
             except Exception as e:
-                # No geotransform -- my guess
-                print(e)
+                attempts = self.failures.get(name, {}).get("attempts", 0) + 1
+                self.failures[name] = {
+                    "error": "{}: {}".format(type(e).__name__, e),
+                    "attempts": attempts,
+                    "definition": layer["definition"],
+                }
+                timer = threading.Timer(self.retry_interval, self._retry, args=(name, layer))
+                timer.daemon = True
+                timer.start()
+                return
+            self._ogc_layers_cache[name] = {"definition": layer["definition"], "node": l}
+            if self.failures.pop(name, None) is not None:
+                # Was not part of the OGC layers returned previously
+                self._version += 1
 
-        if node.style.name:
-            title = node.style.name
-        else:
-            title = name
+    def _retry(self, name, layer):
+        with self._build_lock:
+            current = (self._layers_cache or {}).get(name)
+            if current is not None and current["definition"] == layer["definition"] and name not in self._ogc_layers_cache:
+                self._build(name, current)
+
+    def make_ogc_layer(self, name, layer, abstract=""):
+        kwargs = {}
+        metadata = layer.get("metadata")
+        if metadata is None:
+            # Layers published before the metadata was stored with the definition need to build the node to compute it
+            kwargs["node"] = Node.from_json(json.dumps(layer["definition"]))
+            metadata = make_layer_metadata(kwargs["node"])
+
+        if "valid_times" in metadata:
+            kwargs["valid_times"] = TimeAxis.from_json(metadata["valid_times"])
+        if "grid_coordinates" in metadata:
+            gc = metadata["grid_coordinates"]
+            kwargs["grid_coordinates"] = ogc.GridCoordinates(
+                geotransform=tuple(gc["geotransform"]),
+                x_size=gc["x_size"],
+                y_size=gc["y_size"]
+            )
 
+        title = metadata.get("title") or name
         abstract = layer.get("abstract", "")
 
         ogc_layer = OGCLayer(
             identifier=name,
             title=title,
-            node=node,
+            definition=layer["definition"],
             abstract=abstract,
             convert_requests_to_default_crs=self.convert_requests_to_default_crs,
+            coverage_chunks=self.coverage_chunks,
             **kwargs
             )
         return ogc_layer
 
 
+def document_layer(layer):
+    """
+    Copy of `layer` for rendering the capabilities documents. The OGC library writes the valid times item by item, so
+    regular time axes are reduced to their last value, which `time_axis.compact_time_dimensions` then replaces by the
+    ISO 8601 interval: rendering the documents does not scale with the number of timesteps.
+    """
+    axis = getattr(layer, "valid_times", None)
+    if not isinstance(layer, OGCLayer) or axis is None or not axis.is_regular:
+        return layer
+    # Only the traits that are set, so the node is not built if it was not needed yet
+    traits = {k: v for k, v in layer._trait_values.items() if not k.startswith("_") and k != "valid_times"}
+    return type(layer)(valid_times=TimeAxis.regular(axis.stop, axis.step, 1), **traits)
+
+
+def layer_set_fingerprint(ogc_layers):
+    """
+    Identifies the content of a set of OGC layers (e.g. for the capabilities documents). Unlike `Layers.version`,
+    it is the same for all workers serving the same layers.
+    """
+    items = [(l.identifier, l.title, l.abstract, getattr(l, "definition_hash", None)) for l in ogc_layers]
+    return hashlib.sha1(json.dumps(items).encode("utf8")).hexdigest()
+
+
+def make_layer_metadata(node):
+    """
+    Computes the metadata needed to describe a layer in the capabilities documents. This requires finding the node's
+    coordinates, which can be slow, so it is computed once when publishing and stored next to the definition.
+
+    Parameters
+    ----------
+    node : podpac.Node
+        The published node
+
+    Returns
+    -------
+    OrderedDict
+        JSON-serializable metadata, with the "title" and "outputs" entries, and, if the node has a single set of
+        native coordinates, the "valid_times" (see `TimeAxis.to_json`) and "grid_coordinates" entries.
+    """
+    metadata = OrderedDict()
+    metadata["title"] = node.style.name or None
+    metadata["outputs"] = getattr(node, "outputs", None)
+    coords = node.find_coordinates()
+    if len(coords) == 1:
+        try:
+            coords = coords[0]
+            if "time" in coords.udims:
+                metadata["valid_times"] = TimeAxis(coords["time"].coordinates).to_json()
+                # Need to drop time, otherwise podpac won't give us a geotransform.
+                coords = coords.udrop("time")
+
+            metadata["grid_coordinates"] = OrderedDict([
+                ("geotransform", list(coords.geotransform)),
+                ("x_size", coords["lon"].size),
+                ("y_size", coords["lat"].size),
+            ])
+
+        except Exception as e:
+            # No geotransform -- my guess
+            print(e)
+    return metadata
@@ -0,0 +1,84 @@
+"""
+WebMercatorQuad tile matrix set (the XYZ / "slippy map" tiling scheme, EPSG:3857).
+
+Tiles have fixed, aligned extents, so tile requests always produce the same GetMap arguments, which makes them
+perfectly cacheable (by the server caches, CDNs, and browsers).
+"""
+import math
+
+CRS = "EPSG:3857"
+ORIGIN = 20037508.342789244  # half of the extent of the WebMercator projection, in meters
+MAX_LATITUDE = 85.0511287798066
+
+
+def tile_bounds(z, x, y):
+    """Returns the (min x, min y, max x, max y) bounds of tile `z/x/y` in EPSG:3857 meters. Row `y` = 0 is at the top."""
+    size = 2 * ORIGIN / 2 ** z
+    return (-ORIGIN + x * size, ORIGIN - (y + 1) * size, -ORIGIN + (x + 1) * size, ORIGIN - y * size)
+
+
+def is_valid_tile(z, x, y, max_zoom=24):
+    return 0 <= z <= max_zoom and 0 <= x < 2 ** z and 0 <= y < 2 ** z
+
+
+def lonlat_to_tile(lon, lat, z):
+    """Returns the `(x, y)` index of the tile containing `lon`, `lat` (degrees) at zoom level `z`"""
+    lat = min(max(lat, -MAX_LATITUDE), MAX_LATITUDE)
+    n = 2 ** z
+    x = int((lon + 180.0) / 360.0 * n)
+    y = int((1.0 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2.0 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def tiles_in_bbox(bbox, z):
+    """Yields the `(x, y)` indices of all tiles at zoom level `z` intersecting `bbox` = (west, south, east, north)
+    in degrees"""
+    west, south, east, north = bbox
+    x0, y0 = lonlat_to_tile(west, north, z)
+    x1, y1 = lonlat_to_tile(east, south, z)
+    for x in range(x0, x1 + 1):
+        for y in range(y0, y1 + 1):
+            yield x, y
+
+
+def count_tiles(bbox, z):
+    west, south, east, north = bbox
+    x0, y0 = lonlat_to_tile(west, north, z)
+    x1, y1 = lonlat_to_tile(east, south, z)
+    return (x1 - x0 + 1) * (y1 - y0 + 1)
+
+
+def getmap_args(layer, z, x, y, tile_size=256, extra=None):
+    """WMS 1.3.0 GetMap arguments (upper-case keys) rendering tile `z/x/y` of `layer` as a PNG
+
+    Parameters
+    ----------
+    layer : str
+        Layer name
+    z, x, y : int
+        Tile index
+    tile_size : int, optional
+        Tile width and height in pixels, default 256
+    extra : dict, optional
+        Additional arguments (e.g. TIME, STYLES, PARAMS, TOKEN). These cannot overwrite the tile arguments.
+
+    Returns
+    -------
+    dict
+    """
+    args = {k.upper(): v for k, v in (extra or {}).items()}
+    args.update({
+        "SERVICE": "WMS",
+        "VERSION": "1.3.0",
+        "REQUEST": "GetMap",
+        "LAYERS": layer,
+        "CRS": CRS,
+        # repr gives the shortest exact representation, so the BBOX (and the cache key) is the same for every request
+        "BBOX": ",".join(repr(b) for b in tile_bounds(z, x, y)),
+        "WIDTH": str(tile_size),
+        "HEIGHT": str(tile_size),
+        "FORMAT": "image/png",
+        "TRANSPARENT": "TRUE",
+    })
+    args.setdefault("STYLES", "")
+    return args
@@ -0,0 +1,334 @@
+"""
+Compact representation of the time dimension of published layers.
+
+Long daily series (e.g. 2010 to today) would otherwise be stored as thousands of `datetime` objects per layer, and
+listed item by item in the capabilities documents.
+"""
+from collections.abc import Sequence
+
+import numpy as np
+
+# ISO 8601 duration designators for the numpy datetime64 units
+_DURATIONS = {
+    "Y": "P{}Y",
+    "M": "P{}M",
+    "W": "P{}W",
+    "D": "P{}D",
+    "h": "PT{}H",
+    "m": "PT{}M",
+    "s": "PT{}S",
+}
+
+
+SNAP_MODES = ["exact", "nearest", "previous", "next"]
+
+
+def _linear(value):
+    """`value` (datetime64) in a unit that can be mixed with other units in arithmetic and comparisons. Months and years
+    do not have a fixed length, so numpy refuses to mix them with days or finer units."""
+    if np.datetime_data(value.dtype)[0] in ["Y", "M"]:
+        return value.astype("datetime64[D]")
+    return value
+
+
+def to_datetime64(value):
+    """Convert an ISO 8601 string (a 'Z' UTC designator is allowed), datetime, or datetime64 to a datetime64"""
+    if isinstance(value, str):
+        value = value.strip()
+        if value.endswith("Z"):
+            value = value[:-1]
+    return np.datetime64(value)
+
+
+class TimeAxis(Sequence):
+    """Sorted time axis, stored as start + step * size when it is regular, and as a datetime64 array otherwise.
+
+    It behaves as a (read-only) sequence of `datetime.date` / `datetime.datetime` objects (depending on the unit),
+    like the lists it replaces.
+
+    Parameters
+    ----------
+    values : array-like
+        datetime64 values, or anything numpy can convert to them (e.g. ISO 8601 strings)
+    """
+
+    def __init__(self, values):
+        values = np.sort(np.asarray(values, "datetime64"))
+        self.unit = np.datetime_data(values.dtype)[0]
+        self.size = values.size
+        self.start = values[0] if self.size else None
+        self.step = None
+        self._values = values
+        if self.size > 1:
+            steps = np.diff(values)
+            if (steps == steps[0]).all() and steps[0] > np.timedelta64(0, self.unit):
+                self.step = steps[0]
+                self._values = None  # regular axis, no need to keep the array
+
+    @classmethod
+    def regular(cls, start, step, size):
+        """Create a regular axis directly from its start (datetime64), step (timedelta64) and size"""
+        axis = cls.__new__(cls)
+        start = np.datetime64(start)
+        step = np.timedelta64(step)
+        dtype = np.result_type(start, step)  # datetime64 with the finer of both units
+        axis.unit = np.datetime_data(dtype)[0]
+        axis.start = start.astype(dtype)
+        axis.step = step.astype("timedelta64[{}]".format(axis.unit))
+        axis.size = int(size)
+        axis._values = None
+        return axis
+
+    @property
+    def is_regular(self):
+        return self.step is not None
+
+    @property
+    def stop(self):
+        """Last value of the axis (inclusive)"""
+        if not self.size:
+            return None
+        if self.is_regular:
+            return self.start + self.step * (self.size - 1)
+        return self._values[-1]
+
+    @property
+    def values(self):
+        """datetime64 array of all the values (built on demand for regular axes)"""
+        if self.is_regular:
+            return self.start + self.step * np.arange(self.size)
+        return self._values
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self.size))]
+        if index < 0:
+            index += self.size
+        if not 0 <= index < self.size:
+            raise IndexError("TimeAxis index out of range")
+        if self.is_regular:
+            value = self.start + self.step * index
+        else:
+            value = self._values[index]
+        if self.unit in ["ns", "ps", "fs", "as"]:
+            value = value.astype("datetime64[us]")  # numpy converts these units to int, not datetime
+        return value.astype(object)
+
+    def __contains__(self, value):
+        return self.index(value, "exact") is not None
+
+    def _value(self, index):
+        if self.is_regular:
+            return self.start + self.step * index
+        return self._values[index]
+
+    def _slice(self, start, stop):
+        if self.is_regular:
+            return self.start + self.step * np.arange(start, stop)
+        return self._values[start:stop]
+
+    def _bound(self, value):
+        """Index i such that values[i - 1] <= value < values[i], in O(1) for regular and O(log n) for other axes"""
+        # The axis values are whole multiples of the axis unit, so `value` can be floored to that unit (e.g. 2020-03-15
+        # on a monthly axis is 2020-03) without changing the result. This also avoids casting the whole array when
+        # the value has a finer unit, and mixing months and years with days, which numpy does not allow.
+        value = value.astype("datetime64[{}]".format(self.unit))
+        if self.is_regular:
+            i = int(np.floor((value - self.start) / self.step)) + 1
+            return min(max(i, 0), self.size)
+        return int(np.searchsorted(self._values, value, side="right"))
+
+    def index(self, value, mode="nearest"):
+        """Index of the axis value matching `value`
+
+        Parameters
+        ----------
+        value : str, datetime, datetime64
+            The requested time
+        mode : str, optional
+            'exact', 'nearest' (default), 'previous' (last value <= `value`), or 'next' (first value >= `value`)
+
+        Returns
+        -------
+        int or None
+            None if there is no match (e.g. no exact match or no previous/next value)
+        """
+        if mode not in SNAP_MODES:
+            raise ValueError("Unknown time snapping mode '{}', options are {}".format(mode, SNAP_MODES))
+        if not self.size:
+            return None
+        value = to_datetime64(value)
+        i = self._bound(value)
+        value = _linear(value)
+        previous = i - 1 if i > 0 else None
+        next_ = i if i < self.size else None
+        if previous is not None and _linear(self._value(previous)) == value:
+            return previous
+        if mode == "exact":
+            return None
+        if mode == "previous":
+            return previous
+        if mode == "next" or previous is None:
+            return next_
+        if next_ is None or value - _linear(self._value(previous)) <= _linear(self._value(next_)) - value:
+            return previous
+        return next_
+
+    def resolve(self, times, mode="nearest"):
+        """Resolve a TIME request parameter against the axis
+
+        Parameters
+        ----------
+        times : str
+            ISO 8601 time, range `start/stop[/period]` (the period is ignored: all axis values in the range are used),
+            or comma-separated list of these
+        mode : str, optional
+            How single times are matched, see `index`
+
+        Returns
+        -------
+        np.ndarray
+            The matching datetime64 values of the axis
+
+        Raises
+        ------
+        ValueError
+            If a single time has no match
+        """
+        values = []
+        for item in times.split(","):
+            item = item.strip()
+            if "/" in item:
+                start, stop = item.split("/")[:2]
+                first, last = self.index(start, "next"), self.index(stop, "previous")
+                if first is not None and last is not None and first <= last:
+                    values.append(self._slice(first, last + 1))
+                continue
+            i = self.index(item, mode)
+            if i is None:
+                raise ValueError("TIME '{}' does not match any valid time ('{}' mode)".format(item, mode))
+            values.append(np.array([self._value(i)]))
+        if not values:
+            return np.array([], "datetime64[{}]".format(self.unit))
+        return np.concatenate(values)
+
+    def __repr__(self):
+        return "TimeAxis({})".format(self.isoformat())
+
+    @property
+    def duration(self):
+        """ISO 8601 duration of the step (e.g. 'P1D'), or None if the axis is not regular"""
+        if not self.is_regular:
+            return None
+        count = int(self.step.astype(int))
+        if self.unit in _DURATIONS:
+            return _DURATIONS[self.unit].format(count)
+        # sub-second units
+        seconds = self.step / np.timedelta64(1, "s")
+        return "PT{}S".format(np.format_float_positional(seconds, trim="-"))
+
+    def isoformat(self):
+        """ISO 8601 representation: 'start/stop/step' for regular axes, and a comma-separated list otherwise"""
+        if self.is_regular:
+            return "{}/{}/{}".format(
+                np.datetime_as_string(self.start), np.datetime_as_string(self.stop), self.duration
+            )
+        return ",".join(np.datetime_as_string(self.values).tolist())
+
+    def to_json(self):
+        """JSON-serializable definition, see `from_json`"""
+        if self.is_regular:
+            return {
+                "start": np.datetime_as_string(self.start),
+                "step": [int(self.step.astype(int)), self.unit],
+                "size": self.size,
+            }
+        return np.datetime_as_string(self.values).tolist()
+
+    @classmethod
+    def from_json(cls, definition):
+        """Create an axis from `to_json` output, or a list of ISO 8601 strings"""
+        if isinstance(definition, dict):
+            return cls.regular(
+                np.datetime64(definition["start"]), np.timedelta64(*definition["step"]), definition["size"]
+            )
+        return cls(definition)
+
+
+def compact_time_dimensions(document, valid_times):
+    """Replace the time values listed in a capabilities document by ISO 8601 intervals.
+
+    This handles the WMS `Dimension name="time"` elements and the WCS 1.0.0 `temporalDomain` elements. The server renders
+    the documents with a single value per regular axis (see `server_layers.document_layer`), so the document does not
+    scale with the number of timesteps before it is compacted.
+
+    Parameters
+    ----------
+    document : bytes
+        XML document
+    valid_times : dict
+        layer name --> TimeAxis. Only regular axes are compacted.
+
+    Returns
+    -------
+    bytes
+        The updated document (unchanged if there is nothing to compact)
+    """
+    regular = {name: axis for name, axis in valid_times.items() if axis is not None and axis.is_regular}
+    if not regular:
+        return document
+
+    from lxml import etree
+
+    try:
+        root = etree.fromstring(document)
+    except etree.XMLSyntaxError:
+        return document
+
+    changed = False
+    for element in root.iter(etree.Element):
+        tag = etree.QName(element).localname
+        if tag == "Layer":  # WMS
+            name = _child(element, "Name")
+            axis = regular.get(name.text if name is not None else None)
+            if axis is None:
+                continue
+            for dimension in element:
+                if etree.QName(dimension).localname in ["Dimension", "Extent"] and dimension.get("name") == "time":
+                    dimension.text = axis.isoformat()
+                    changed = True
+        elif tag == "CoverageOffering":  # WCS 1.0.0 DescribeCoverage
+            name = _child(element, "name")
+            axis = regular.get(name.text if name is not None else None)
+            if axis is None:
+                continue
+            for domain in element.iter("{*}temporalDomain"):
+                _set_time_period(domain, axis)
+                changed = True
+
+    if not changed:
+        return document
+    return etree.tostring(root, xml_declaration=document.lstrip().startswith(b"<?xml"), encoding="UTF-8")
+
+
+def _child(element, localname):
+    for child in element:
+        if isinstance(child.tag, str) and child.tag.split("}")[-1] == localname:
+            return child
+    return None
+
+
+def _set_time_period(domain, axis):
+    from lxml import etree
+
+    gml = "http://www.opengis.net/gml"
+    wcs = etree.QName(domain).namespace or "http://www.opengis.net/wcs"
+    for child in list(domain):
+        domain.remove(child)
+    period = etree.SubElement(domain, "{%s}timePeriod" % wcs)
+    etree.SubElement(period, "{%s}beginPosition" % gml).text = np.datetime_as_string(axis.start)
+    etree.SubElement(period, "{%s}endPosition" % gml).text = np.datetime_as_string(axis.stop)
+    etree.SubElement(period, "{%s}timeResolution" % wcs).text = axis.duration
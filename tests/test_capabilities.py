@@ -0,0 +1,36 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+pytest.importorskip("ogc")
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from time_axis import TimeAxis, compact_time_dimensions
+from server_layers import OGCLayer, document_layer
+
+DEFINITION = {"SinCoords": {"node": "core.algorithm.utility.SinCoords"}}
+
+
+def test_document_layer_has_a_single_time():
+    axis = TimeAxis.regular(np.datetime64("2010-01-01"), np.timedelta64(1, "D"), 5000)
+    layer = OGCLayer(identifier="Daily", title="Daily layer", definition=DEFINITION, valid_times=axis)
+    copy = document_layer(layer)
+    assert copy is not layer
+    assert (copy.identifier, copy.title, copy.definition) == (layer.identifier, layer.title, layer.definition)
+    assert list(copy.valid_times.values) == [axis.stop]
+    assert len(layer.valid_times) == 5000
+    assert "node" not in copy._trait_values  # not built for the documents
+
+
+def test_irregular_axes_are_listed():
+    layer = OGCLayer(identifier="Irregular", definition=DEFINITION, valid_times=TimeAxis(["2010-01-01", "2010-01-02", "2010-01-05"]))
+    assert document_layer(layer) is layer
+
+
+def test_single_time_is_replaced_by_the_interval():
+    axis = TimeAxis.regular(np.datetime64("2010-01-01"), np.timedelta64(1, "D"), 5000)
+    document = b'<Layer><Name>Daily</Name><Dimension name="time">2023-09-09</Dimension></Layer>'
+    assert b">2010-01-01/2023-09-09/P1D<" in compact_time_dimensions(document, {"Daily": axis})
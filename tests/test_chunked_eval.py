@@ -0,0 +1,44 @@
+import os
+import sys
+
+import numpy as np
+import podpac
+from podpac.core.algorithm.stats import Mean
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from chunked_eval import ChunkedEval, chunk_large_request, is_chunkable
+
+COORDINATES = podpac.Coordinates(
+    [podpac.clinspace(10, 0, 7, "lat"), podpac.clinspace(0, 10, 5, "lon"), ["2020-01-01", "2020-01-02"]],
+    dims=["lat", "lon", "time"],
+)
+
+
+def test_same_output_as_direct_evaluation():
+    source = podpac.algorithm.SinCoords(units="m")
+    expected = source.eval(COORDINATES)
+    output = ChunkedEval(source=source, chunk_size=2, max_workers=2).eval(COORDINATES)
+    assert output.dims == expected.dims
+    np.testing.assert_allclose(output.data, expected.data)
+    assert output.attrs["units"] == "m"
+    assert sorted(output.attrs) == sorted(expected.attrs)
+    for key in ["units", "crs", "layer_style"]:
+        assert output.attrs[key] == expected.attrs[key]
+
+
+def test_output_array_in_another_order():
+    source = podpac.algorithm.SinCoords()
+    node = ChunkedEval(source=source, chunk_size=3)
+    output = node.create_output_array(COORDINATES.transpose("time", "lon", "lat"))
+    node.eval(COORDINATES, output=output)
+    np.testing.assert_allclose(output.transpose(*COORDINATES.dims).data, source.eval(COORDINATES).data)
+
+
+def test_shape_dependent_pipelines_are_not_chunked():
+    arange = podpac.algorithm.Arange()
+    assert not is_chunkable(arange)
+    assert not is_chunkable(podpac.algorithm.Arithmetic(A=arange, B=podpac.algorithm.SinCoords(), eqn="A+B"))
+    assert not is_chunkable(Mean(source=podpac.algorithm.SinCoords(), dims=["lat"]))
+    assert is_chunkable(Mean(source=podpac.algorithm.SinCoords(), dims=["time"]))
+    assert chunk_large_request(arange, 10 ** 6, max_pixels=10) is arange
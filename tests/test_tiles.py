@@ -0,0 +1,61 @@
+"""
+XYZ tiles of freshly published layers, through the Flask test client.
+
+    cd tests && python -m pytest
+"""
+import os
+import sys
+import json
+import importlib
+
+import pytest
+
+pytest.importorskip("ogc")
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+KEY = "test-key"
+ARANGE = '{"Arange": {"node": "core.algorithm.utility.Arange"}}'
+SIN = '{"SinCoords": {"node": "core.algorithm.utility.SinCoords"}}'
+
+
+@pytest.fixture(scope="module")
+def server(tmp_path_factory):
+    tmp = tmp_path_factory.mktemp("server")
+    store = str(tmp / "layers.json")
+    with open(store, "w") as file:
+        json.dump({}, file)
+    os.environ["SETTINGS"] = json.dumps({"PUBLISHED_PIPELINES": {"path": store, "secret_key": [KEY]}})
+    cwd = os.getcwd()
+    os.chdir(str(tmp))
+    sys.path.insert(0, SRC)
+    try:
+        yield importlib.import_module("server")
+    finally:
+        os.chdir(cwd)
+
+
+def publish(client, name, definition):
+    response = client.get("/api/publish/", query_string={"SERVICE": "PUBLISH", "KEY": KEY, "NAME": name, "DATA": definition})
+    assert response.status_code == 200
+
+
+def test_tile_of_a_layer_published_by_this_worker(server):
+    client = server.app.test_client()
+    publish(client, "Published", ARANGE)
+    assert client.get("/api/tiles/Published/1/0/0.png").status_code == 200
+
+    tiles = json.loads(client.get("/api/tiles/Published.json").data)["tiles"]
+    publish(client, "Published", SIN)
+    republished = json.loads(client.get("/api/tiles/Published.json").data)["tiles"]
+    assert republished != tiles  # the URLs carry the definition hash
+    assert client.get("/api/tiles/Published/1/0/0.png").status_code == 200
+
+
+def test_tile_of_a_layer_published_by_another_worker(server):
+    client = server.app.test_client()
+    publish(client, "Local", ARANGE)
+    # Another worker writes to the layer store directly
+    item = dict(server.LAYERS.store.get("Local"))
+    server.LAYERS.store.set("Remote", item)
+    assert client.get("/api/tiles/Remote/1/0/0.png").status_code == 200
+    assert client.get("/api/tiles/Remote.json").status_code == 200
@@ -0,0 +1,34 @@
+import os
+import sys
+import datetime
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from time_axis import TimeAxis
+
+MONTHLY = TimeAxis.regular(np.datetime64("2020-01"), np.timedelta64(1, "M"), 12)
+MONTHLY_IRREGULAR = TimeAxis(np.array(["2020-01", "2020-03", "2021-01"], "datetime64[M]"))
+
+
+@pytest.mark.parametrize("axis", [MONTHLY, MONTHLY_IRREGULAR])
+def test_day_precision_time_on_monthly_axis(axis):
+    assert axis.index("2020-03-01", "exact") == list(axis.values).index(np.datetime64("2020-03"))
+    assert axis.index("2020-03-15", "exact") is None
+    assert axis.values[axis.index("2020-03-15", "previous")] == np.datetime64("2020-03")
+    assert axis.values[axis.index("2020-02-20T12:00", "next")] == np.datetime64("2020-03")
+
+
+def test_nearest_on_monthly_axis():
+    assert MONTHLY.values[MONTHLY.index("2020-03-15")] == np.datetime64("2020-03")  # 14 days vs 17 days
+    assert MONTHLY.values[MONTHLY.index("2020-03-20")] == np.datetime64("2020-04")
+    assert MONTHLY.resolve("2020-02-10/2020-05-01").tolist() == np.array(
+        ["2020-03", "2020-04", "2020-05"], "datetime64[M]").tolist()
+
+
+def test_items_are_datetimes_for_nanosecond_axis():
+    axis = TimeAxis(np.array(["2020-01-01T00:00:00.000000001", "2020-01-05"], "datetime64[ns]"))
+    assert all(isinstance(value, datetime.datetime) for value in axis)
+    assert axis[1] == datetime.datetime(2020, 1, 5)